@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import timeit
+
+import teamutil
+
+
+def generate_users(num_users: int, seed: int=None, request_density: float=1.5, mutual_ratio: float=0.6, specialities: dict=None, noob_ratio: float=0.4) -> list:
+    '''
+    makes up a hackathon's worth of user_requests, the same each time for the
+    same arguments.
+
+    request_density is the average number of teammates each person requests
+    (never more than TEAM_SIZE - 1), mutual_ratio the chance that a request
+    is returned, specialities maps each speciality to the share of people who
+    have it (defaults to a third each), and noob_ratio is the share of noobs
+    '''
+    rng = random.Random(seed)
+    if specialities is None:
+        specialities = {speciality: 1 / len(teamutil.SPECIALITIES) for speciality in teamutil.SPECIALITIES}
+
+    users = [
+        {
+            'username': 'user%d' % i,
+            'specialities': [speciality for speciality, share in specialities.items() if rng.random() < share],
+            'team_requests': list(),
+            'noob': rng.random() < noob_ratio
+        }
+        for i in range(num_users)
+    ]
+
+    # people request friends, and friends know each other, so requests go to
+    # people close by in a random seating order rather than anyone at all
+    seating = list(range(num_users))
+    rng.shuffle(seating)
+    seat_of = {user_no: seat for seat, user_no in enumerate(seating)}
+    max_requests = teamutil.TEAM_SIZE - 1
+    chance = min(request_density / max_requests, 1.0) if max_requests else 0.0
+
+    for user_no in range(num_users):
+        user = users[user_no]
+        wanted = sum(rng.random() < chance for x in range(max_requests))
+        # a few tries each, there might not be that many people close by
+        for x in range(wanted * 4):
+            if len(user['team_requests']) >= wanted:
+                break
+
+            seat = seat_of[user_no] + rng.randint(-teamutil.TEAM_SIZE, teamutil.TEAM_SIZE)
+            if not 0 <= seat < num_users or seating[seat] == user_no:
+                continue
+
+            friend = users[seating[seat]]
+            if friend['username'] in user['team_requests']:
+                continue
+            user['team_requests'].append(friend['username'])
+
+            if rng.random() < mutual_ratio and user['username'] not in friend['team_requests'] and len(friend['team_requests']) < max_requests:
+                friend['team_requests'].append(user['username'])
+
+    return users
+
+
+def mutual_satisfied(user_requests: list, teams: list) -> float:
+    '''
+    percentage of mutual request pairs that ended up on the same team
+    '''
+    team_of = {user['username']: team_no for team_no, team in enumerate(teams) for user in team}
+    requested = {user['username']: set(user['team_requests']) for user in user_requests}
+
+    pairs = together = 0
+    for username, requests in requested.items():
+        for other in requests:
+            if other > username and username in requested.get(other, ()):
+                pairs += 1
+                together += team_of.get(username) == team_of.get(other)
+
+    return 100.0 * together / pairs if pairs else 100.0
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def micro(num_users: int=1000, seed: int=None, number: int=20000) -> dict:
+    '''
+    times score_team() against the ScoringEngine on random full teams.
+    returns microseconds per call for each
+    '''
+    users = generate_users(num_users, seed)
+    rng = random.Random(seed)
+    teams = [rng.sample(users, teamutil.TEAM_SIZE) for x in range(256)]
+
+    engine = teamutil.ScoringEngine(users)
+    id_teams = [[engine.ids[user['username']] for user in team] for team in teams]
+    engine.load([list(range(i, i + teamutil.TEAM_SIZE)) for i in range(0, num_users - num_users % teamutil.TEAM_SIZE, teamutil.TEAM_SIZE)])
+    swaps = [(rng.randrange(len(engine.members)), rng.randrange(len(engine.members))) for x in range(256)]
+    swaps = [(team1_no, team2_no) for team1_no, team2_no in swaps if team1_no != team2_no]
+
+    def score_team():
+        for team in teams:
+            teamutil.score_team(team)
+
+    def score_members():
+        for team in id_teams:
+            engine.score_members(team)
+
+    def propose():
+        for team1_no, team2_no in swaps:
+            engine.propose(team1_no, team2_no, {engine.members[team1_no][0]}, {engine.members[team2_no][0]})
+
+    results = dict()
+    for name, function, calls in (('score_team', score_team, len(teams)), ('engine.score_members', score_members, len(id_teams)), ('engine.propose', propose, len(swaps))):
+        rounds = max(number // calls, 1)
+        # best of a few repeats, the others are mostly noise from the machine
+        seconds = min(timeit.repeat(function, number=rounds, repeat=5))
+        results[name] = {'calls': rounds * calls, 'us_per_call': seconds / (rounds * calls) * 1e6}
+
+    return results
+
+
+def macro(num_users: int, method: str='hillclimb', seed: int=None, time_budget: float=None, max_iterations: int=None, anneal: bool=False, contract: bool=False, generator: dict=None, start: str='greedy') -> dict:
+    '''
+    generates num_users users and optimizes their teams once. returns the
+    wall time, iterations, final total score, percentage of mutual requests
+    that were satisfied and the peak memory of this process
+    '''
+    users = generate_users(num_users, seed, **(generator or dict()))
+
+    start_time = time.perf_counter()
+    optimizer = teamutil.TeamOptimizer(users, method, rng=random.Random(seed), anneal=anneal, contract=contract, start=start)
+    setup_time = time.perf_counter() - start_time
+    initial_score = optimizer.best_score
+    teams = optimizer.run(time_budget=time_budget, max_iterations=max_iterations)
+    wall_time = time.perf_counter() - start_time
+
+    return {
+        'users': num_users,
+        'method': method,
+        'anneal': anneal,
+        'contract': contract,
+        'start': start,
+        'time_budget': time_budget,
+        'max_iterations': max_iterations,
+        'setup_seconds': setup_time,
+        'wall_seconds': wall_time,
+        'iterations': optimizer.iterations,
+        'iterations_per_second': optimizer.iterations / max(wall_time - setup_time, 1e-9),
+        'stop_reason': optimizer.stop_reason,
+        'initial_score': initial_score,
+        'score': sum(teamutil.score_team(team) for team in teams),
+        'mutual_satisfied_percent': mutual_satisfied(users, teams),
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+
+def cache(num_users: int, seed: int=None, max_iterations: int=200000, cache_size: int=65536) -> dict:
+    '''
+    runs the same hill climb (same seed and iteration count) without and
+    with a ScoreCache of cache_size entries. the cache can't change what the
+    optimizer does, only how fast, so the scores have to come out equal
+    '''
+    users = generate_users(num_users, seed)
+
+    results = dict()
+    for size in (None, cache_size):
+        optimizer = teamutil.TeamOptimizer(users, 'hillclimb', rng=random.Random(seed), score_cache=size)
+        optimizer.run(max_iterations=max_iterations)
+        results[size] = optimizer.stats()
+
+    plain, cached = results[None], results[cache_size]
+    return {
+        'users': num_users,
+        'cache_size': cache_size,
+        'iterations': cached['iterations'],
+        'seconds': plain['elapsed'],
+        'cached_seconds': cached['elapsed'],
+        'speedup': plain['elapsed'] / max(cached['elapsed'], 1e-9),
+        'scoring_speedup': plain['scoring_seconds'] / max(cached['scoring_seconds'], 1e-9),
+        'hit_rate': cached['cache']['hit_rate'],
+        'same_score': plain['best_score'] == cached['best_score']
+    }
+
+
+def _revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: list, methods: list, seed: int=0, time_budget: float=None, max_iterations: int=None, anneal: bool=False, contract: bool=False, generator: dict=None, skip_micro: bool=False, start: str='greedy', cache_sizes: list=None) -> dict:
+    '''
+    runs the micro benchmarks, then a macro benchmark for every size and
+    method. each macro benchmark gets a fresh process so the peak memory is
+    its own. with cache_sizes, also compares the hill climb with and without
+    a score cache of each size at every event size
+    '''
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'team_size': teamutil.TEAM_SIZE,
+        'seed': seed,
+        'generator': generator or dict(),
+        'micro': None if skip_micro else micro(seed=seed),
+        'macro': list(),
+        'cache': list()
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for num_users in sizes:
+        for method in methods:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(macro, num_users, method, seed, time_budget, max_iterations, anneal and method == 'hillclimb', contract, generator, start).result()
+            print('[ ] %d users, %s: score %.1f, %.1f%% mutual satisfied, %d iterations in %.2fs' % (num_users, method, result['score'], result['mutual_satisfied_percent'], result['iterations'], result['wall_seconds']), file=sys.stderr)
+            report['macro'].append(result)
+
+    for num_users in sizes if cache_sizes else ():
+        for cache_size in cache_sizes:
+            result = cache(num_users, seed, max_iterations or 200000, cache_size)
+            print('[ ] %d users, score cache of %d: %.1f%% hits, %.2fx faster' % (num_users, cache_size, 100 * (result['hit_rate'] or 0), result['speedup']), file=sys.stderr)
+            report['cache'].append(result)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks teamutil on generated hackathons and prints the results as json')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 2000, 10000], help='numbers of competitors to try')
+    parser.add_argument('--methods', nargs='+', default=['hillclimb', 'batch'], choices=['hillclimb', 'batch'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-budget', type=float, default=10, help='seconds per optimization (0 runs until it stalls)')
+    parser.add_argument('--max-iterations', type=int)
+    parser.add_argument('--anneal', action='store_true', help='anneal the hillclimb runs')
+    parser.add_argument('--contract', action='store_true', help='move mutual request groups as units')
+    parser.add_argument('--start', default='greedy', choices=['greedy', 'random'], help='starting assignment')
+    parser.add_argument('--request-density', type=float, default=1.5, help='average requests per person')
+    parser.add_argument('--mutual-ratio', type=float, default=0.6, help='chance a request is returned')
+    parser.add_argument('--noob-ratio', type=float, default=0.4)
+    parser.add_argument('--speciality', action='append', default=[], metavar='NAME=SHARE', help='share of people with a speciality, e.g. ui/ux=0.2 (repeatable)')
+    parser.add_argument('--cache-sizes', type=int, nargs='+', metavar='ENTRIES', help='also compare the hill climb with score caches of these sizes (runs --max-iterations, default 200000)')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--output', '-o', help='write the json here instead of stdout')
+    args = parser.parse_args()
+
+    generator = {
+        'request_density': args.request_density,
+        'mutual_ratio': args.mutual_ratio,
+        'noob_ratio': args.noob_ratio
+    }
+    if args.speciality:
+        generator['specialities'] = {name: float(share) for name, share in (x.rsplit('=', 1) for x in args.speciality)}
+
+    report = run(args.sizes, args.methods, seed=args.seed, time_budget=args.time_budget or None, max_iterations=args.max_iterations, anneal=args.anneal, contract=args.contract, generator=generator, skip_micro=args.skip_micro, start=args.start, cache_sizes=args.cache_sizes)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
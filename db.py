@@ -1,33 +1,446 @@
 #!/usr/bin/env python3
-# XXX: this file is kind of a hack, but this discord bot is only gonna be used 
+# XXX: this file is kind of a hack, but this discord bot is only gonna be used
 # once, so I don't think it matters much.
 
+# storage is a snapshot (db.yml or db.pickle) plus an append-only journal of json
+# lines (db.journal), one per changed user or top-level key. read() loads the
+# snapshot and replays the journal on top of it; every COMPACT_AFTER records
+# the journal is folded back into a new snapshot in a background thread.
+# records always hold the full new value, so replaying one twice is harmless.
+
 import yaml
+import json
+import pickle
+import sys
 import os
+import time
+import shutil
+import threading
+import asyncio
+import logging
+
+# libyaml is a lot faster when pyyaml was built with it
+try:
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
+# snapshots are yaml (readable, the default) or pickle (loads in a fraction
+# of the time on big events). read() uses whichever snapshot is newest, so the
+# format can be switched at any time
+SNAPSHOT_FORMAT = 'yaml'
+SNAPSHOT_PATHS = {
+    'yaml': 'db.yml',
+    'pickle': 'db.pickle'
+}
+JOURNAL_PATH = 'db.journal'
+
+log = logging.getLogger('db')
+
+# fsync the journal after this many records or seconds, whichever comes first
+FSYNC_EVERY = 64
+FSYNC_INTERVAL = 1.0
+
+# records to append before compacting the journal into a new snapshot
+COMPACT_AFTER = 5000
+
+# write() coalescing: flush at most every FLUSH_INTERVAL seconds, or sooner
+# once FLUSH_AFTER users are dirty
+FLUSH_INTERVAL = 0.25
+FLUSH_AFTER = 100
 
 db = {
     'users': {}
 }
 
+metrics = {
+    'writes': 0, # write() calls
+    'coalesced': 0, # write() calls folded into a pending one
+    'records': 0, # journal records produced
+    'flushes': 0,
+    'flush_seconds_total': 0.0,
+    'flush_seconds_max': 0.0
+}
 
-def read() -> None:
-    global db
+_journal = None
+_journal_records = 0 # since the last snapshot
+_unsynced_records = 0
+_last_fsync = 0.0
+_compaction = None
+
+# dirty users (or everything) waiting to be collected into journal lines,
+# and collected lines waiting to be appended
+_dirty_users = set()
+_dirty_keys = set()
+_dirty_all = False
+_pending_lines = list()
+_pending_lock = threading.Lock()
+_io_lock = threading.RLock()
+
+_flusher = None
+_flush_soon = None
+
+# json of everything as of its last journal record, used to find what changed
+# and to build snapshots without touching the live dict from another thread
+_persisted_users = dict()
+_persisted_keys = dict()
+
+
+def _encode(value) -> str:
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def _apply(record: dict) -> None:
+    if 'user' in record:
+        if 'value' in record:
+            db['users'][record['user']] = record['value']
+        else:
+            db['users'].pop(record['user'], None)
+    else:
+        if 'value' in record:
+            db[record['key']] = record['value']
+        else:
+            db.pop(record['key'], None)
+
+
+def _replay(path: str) -> int:
+    count = 0
     try:
-        with open('db.yml', 'r') as f:
-            db = yaml.safe_load(f)
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a crash in the middle of an append leaves half a line at
+                    # the end; everything before it is still good
+                    log.warning('skipping corrupt journal record in %s: %r', path, line[:80])
+                    continue
+                _apply(record)
+                count += 1
     except FileNotFoundError:
-        # the file will be created next write
         pass
-    print('[ ] read db size: %d' % len(str(db)))
+    return count
+
 
+def _snapshot_format(path: str) -> str:
+    return 'pickle' if path.endswith('.pickle') else 'yaml'
 
-def write() -> None:
-    global db
-    print('[ ] write db size: %d' % len(str(db)))
+
+def _load_snapshot(path: str) -> dict:
+    if _snapshot_format(path) == 'pickle':
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+def _dump_snapshot(snapshot: dict, path: str) -> None:
     # write to different file THEN move to avoid potential race condition
     # between opening and writing to files
-    with open('db.yml.tmp', 'w') as f:
-        f.write(yaml.dump(db))
-    
-    os.rename('db.yml.tmp', 'db.yml')
+    if _snapshot_format(path) == 'pickle':
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f, protocol=5)
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(path + '.tmp', 'w') as f:
+            yaml.dump(snapshot, f, Dumper=_YamlDumper)
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.rename(path + '.tmp', path)
+
+
+def read() -> None:
+    global db, _journal, _journal_records
+    start_time = time.monotonic()
+
+    # the newest snapshot wins, in case the format was changed
+    snapshots = [path for path in SNAPSHOT_PATHS.values() if os.path.exists(path)]
+    if snapshots:
+        db = _load_snapshot(max(snapshots, key=os.path.getmtime))
+    # otherwise the file will be created on the first compaction
+
+    # a journal left over from a compaction that didn't finish, then the
+    # current one
+    _journal_records = _replay(JOURNAL_PATH + '.old') + _replay(JOURNAL_PATH)
+    log.info('read db: %d users, replayed %d journal records in %.2fs', len(db['users']), _journal_records, time.monotonic() - start_time)
+
+    _persisted_users.clear()
+    _persisted_users.update((username, _encode(user)) for username, user in db['users'].items())
+    _persisted_keys.clear()
+    _persisted_keys.update((key, _encode(value)) for key, value in db.items() if key != 'users')
+
+    _journal = open(JOURNAL_PATH, 'a')
+    if _journal_records:
+        compact()
+
+
+def _encode_record(record: dict) -> str:
+    metrics['records'] += 1
+    return _encode(record) + '\n'
+
+
+def _collect() -> list:
+    '''
+    turns everything marked dirty into journal lines. runs on the thread that
+    owns db.db (the event loop), and only costs as much as what changed
+    unless a full write() was asked for
+    '''
+    global _dirty_all
+    lines = list()
+
+    if _dirty_all:
+        _dirty_users.clear()
+        _dirty_keys.clear()
+        _dirty_all = False
+
+        for username, user in db['users'].items():
+            encoded = _encode(user)
+            if _persisted_users.get(username) != encoded:
+                _persisted_users[username] = encoded
+                lines.append(_encode_record({'user': username, 'value': user}))
+        for username in set(_persisted_users) - set(db['users']):
+            del _persisted_users[username]
+            lines.append(_encode_record({'user': username}))
+
+        for key, value in db.items():
+            if key == 'users':
+                continue
+            encoded = _encode(value)
+            if _persisted_keys.get(key) != encoded:
+                _persisted_keys[key] = encoded
+                lines.append(_encode_record({'key': key, 'value': value}))
+        for key in set(_persisted_keys) - set(db):
+            del _persisted_keys[key]
+            lines.append(_encode_record({'key': key}))
+
+    while _dirty_users:
+        username = _dirty_users.pop()
+        if username in db['users']:
+            _persisted_users[username] = _encode(db['users'][username])
+            lines.append(_encode_record({'user': username, 'value': db['users'][username]}))
+        elif _persisted_users.pop(username, None) is not None:
+            lines.append(_encode_record({'user': username}))
+
+    while _dirty_keys:
+        key = _dirty_keys.pop()
+        if key in db:
+            _persisted_keys[key] = _encode(db[key])
+            lines.append(_encode_record({'key': key, 'value': db[key]}))
+        elif _persisted_keys.pop(key, None) is not None:
+            lines.append(_encode_record({'key': key}))
+
+    with _pending_lock:
+        _pending_lines.extend(lines)
+    return lines
+
+
+def _drain(force_fsync: bool=False) -> None:
+    '''
+    appends the collected lines to the journal. safe to call from any thread;
+    lines always land in the order they were collected in
+    '''
+    global _journal, _journal_records, _unsynced_records, _last_fsync
+    with _io_lock:
+        with _pending_lock:
+            lines = _pending_lines[:]
+            _pending_lines.clear()
+
+        if not lines and not force_fsync and not _unsynced_records:
+            return
+
+        start_time = time.monotonic()
+        try:
+            if _journal is None:
+                _journal = open(JOURNAL_PATH, 'a')
+            _journal.writelines(lines)
+            _journal.flush()
+        except OSError:
+            # put them back for the next flush. if some made it to disk they
+            # get written twice, which replays the same
+            with _pending_lock:
+                _pending_lines[:0] = lines
+            raise
+        _journal_records += len(lines)
+        _unsynced_records += len(lines)
+
+        if force_fsync or _unsynced_records >= FSYNC_EVERY or time.monotonic() - _last_fsync >= FSYNC_INTERVAL:
+            os.fsync(_journal.fileno())
+            _unsynced_records = 0
+            _last_fsync = time.monotonic()
+
+        if _journal_records >= COMPACT_AFTER:
+            _compact(False)
+
+        if not lines:
+            return
+
+        elapsed = time.monotonic() - start_time
+        metrics['flushes'] += 1
+        metrics['flush_seconds_total'] += elapsed
+        metrics['flush_seconds_max'] = max(metrics['flush_seconds_max'], elapsed)
+
+
+def write(*usernames: str, keys: tuple=()) -> None:
+    '''
+    marks changes to db to be persisted. with usernames (and/or top-level
+    keys other than 'users') only those are written, otherwise everything is
+    compared against what was last written.
+
+    once start_flusher() has been called this only marks things dirty, and
+    the flusher writes them out in batches; before that it writes right away
+    '''
+    metrics['writes'] += 1
+
+    global _dirty_all
+    if usernames or keys:
+        for username in usernames:
+            if username in _dirty_users or _dirty_all:
+                metrics['coalesced'] += 1
+            _dirty_users.add(username)
+        for key in keys:
+            if key in _dirty_keys or _dirty_all:
+                metrics['coalesced'] += 1
+            _dirty_keys.add(key)
+    else:
+        if _dirty_all:
+            metrics['coalesced'] += 1
+        _dirty_all = True
+
+    if _flusher is None:
+        _collect()
+        _drain()
+    elif _dirty_all or len(_dirty_users) >= FLUSH_AFTER:
+        _flush_soon.set()
+
+
+def flush() -> None:
+    '''
+    writes everything marked dirty and fsyncs it before returning. call from
+    the thread that owns db.db
+    '''
+    _collect()
+    _drain(force_fsync=True)
+
+
+async def _run_flusher() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        # not wait_for(), which can swallow our own cancellation if the event
+        # gets set at the same time
+        waiter = asyncio.ensure_future(_flush_soon.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=FLUSH_INTERVAL)
+        finally:
+            waiter.cancel()
+        _flush_soon.clear()
+
+        if _dirty_users or _dirty_keys or _dirty_all:
+            _collect()
+        if _pending_lines or _unsynced_records:
+            # the slow part (disk) happens off the event loop
+            try:
+                await loop.run_in_executor(None, _drain)
+            except OSError as e:
+                # the lines are kept and retried next time around
+                log.error('db flush failed: %s', e)
+
+
+def start_flusher() -> None:
+    '''
+    starts flushing writes in the background from the running event loop, at
+    most every FLUSH_INTERVAL seconds or after FLUSH_AFTER dirty users
+    '''
+    global _flusher, _flush_soon
+    if _flusher is not None and not _flusher.done():
+        return
+    _flush_soon = asyncio.Event()
+    _flusher = asyncio.get_running_loop().create_task(_run_flusher())
+
+
+def _write_snapshot(users: dict, keys: dict) -> None:
+    snapshot = {key: json.loads(value) for key, value in keys.items()}
+    snapshot['users'] = {username: json.loads(user) for username, user in users.items()}
+
+    _dump_snapshot(snapshot, SNAPSHOT_PATHS[SNAPSHOT_FORMAT])
+    os.remove(JOURNAL_PATH + '.old')
+    log.info('compacted db journal into %s', SNAPSHOT_PATHS[SNAPSHOT_FORMAT])
+
+
+def compact(wait: bool=False) -> None:
+    '''
+    starts folding the journal into a new snapshot in the background
+    '''
+    with _io_lock:
+        _compact(wait)
+
+
+def _compact(wait: bool) -> None:
+    global _journal, _journal_records, _compaction
+    if _compaction and _compaction.is_alive():
+        # still busy with the last one, try again on a later write
+        if not wait:
+            return
+        _compaction.join()
+
+    # everything up to here goes into the snapshot, new records go to a fresh
+    # journal
+    if _journal is None:
+        _journal = open(JOURNAL_PATH, 'a')
+    _journal.flush()
+    os.fsync(_journal.fileno())
+    _journal.close()
+    if os.path.exists(JOURNAL_PATH + '.old'):
+        # left over from a compaction that never finished, its records aren't
+        # in the snapshot yet so keep them
+        with open(JOURNAL_PATH + '.old', 'a') as old, open(JOURNAL_PATH, 'r') as current:
+            shutil.copyfileobj(current, old)
+        os.remove(JOURNAL_PATH)
+    else:
+        os.replace(JOURNAL_PATH, JOURNAL_PATH + '.old')
+    _journal = open(JOURNAL_PATH, 'a')
+    _journal_records = 0
+
+    _compaction = threading.Thread(target=_write_snapshot, args=(_persisted_users.copy(), _persisted_keys.copy()), name='db-compaction')
+    _compaction.start()
+    if wait:
+        _compaction.join()
+
+
+def close() -> None:
+    '''
+    makes sure everything written so far is on disk
+    '''
+    global _journal, _flusher
+    if _flusher is not None:
+        if not _flusher.done():
+            _flusher.cancel()
+        _flusher = None
+    flush()
+    if _compaction:
+        _compaction.join()
+    if _journal:
+        _journal.flush()
+        os.fsync(_journal.fileno())
+        _journal.close()
+        _journal = None
+
+
+def convert(source: str, destination: str) -> None:
+    '''
+    one-shot conversion between snapshot formats, picked by file extension
+    (.yml/.pickle). doesn't look at the journal
+    '''
+    _dump_snapshot(_load_snapshot(source), destination)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'convert':
+        print('usage: %s convert <source> <destination>   e.g. convert db.yml db.pickle' % sys.argv[0])
+        sys.exit(1)
 
+    start_time = time.monotonic()
+    convert(sys.argv[2], sys.argv[3])
+    print('[ ] converted %s to %s in %.2fs' % (sys.argv[2], sys.argv[3], time.monotonic() - start_time))
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import bench
+import logutil
+import teamutil
+
+# main is imported by replay(), from inside the work directory, because it
+# opens its log file (and the db) in the current directory
+
+
+GUILD_ID = 1000
+COMPETITOR_ROLE_ID = 1001
+ORGANIZER_ROLE_ID = 1002
+REQUESTS_CHANNEL_ID = 2001
+MAKETEAMS_CHANNEL_ID = 2002
+SPECIALIZATIONS_CHANNEL_ID = 2003
+SPECIALIZATIONS_MESSAGE_ID = 3001
+
+# as in config.yml.example
+SPECIALITY_EMOJIS = {
+    'regional_indicator_a': 'noob',
+    'regional_indicator_b': 'ui/ux',
+    'regional_indicator_c': 'backend',
+    'regional_indicator_d': 'software'
+}
+
+ORGANIZER = 'organizer'
+
+
+class FakeREST:
+    '''
+    stands in for discord's REST api: every call takes a random latency
+    (lognormal around `latency` seconds) and rate_limit_ratio of them come
+    back 429 first, which gets logged on discord.http and retried after
+    retry_after seconds like discord.py does
+    '''
+
+    def __init__(self, latency: float=0.05, rate_limit_ratio: float=0.0, retry_after: float=1.0, rng: random.Random=None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rng = random.Random() if rng is None else rng
+        self.calls = dict() # route => count
+        self.rate_limited = 0
+        self._ids = itertools.count(10 ** 6)
+
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+
+    async def call(self, route: str) -> None:
+        self.calls[route] = self.calls.get(route, 0) + 1
+        while True:
+            await asyncio.sleep(self.latency * self.rng.lognormvariate(0, 0.5) if self.latency else 0)
+            if self.rng.random() >= self.rate_limit_ratio:
+                return
+
+            self.rate_limited += 1
+            logging.getLogger('discord.http').warning('We are being rate limited. %s responded with 429. Retrying in %.2f seconds.', route, self.retry_after)
+            await asyncio.sleep(self.retry_after)
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+        self.members = list()
+
+
+class FakeMember:
+    def __init__(self, member_id: int, name: str, guild, roles: list):
+        self.id = member_id
+        self.name = name
+        self.nick = None
+        self.global_name = None
+        self.bot = False
+        self.guild = guild
+        self.roles = roles
+        for role in roles:
+            role.members.append(self)
+
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel, content: str=None):
+        self.id = message_id
+        self.channel = channel
+        self.content = content
+
+
+    async def add_reaction(self, emoji) -> None:
+        await self.channel.guild.rest.call('PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me')
+
+
+    async def remove_reaction(self, emoji, member) -> None:
+        await self.channel.guild.rest.call('DELETE /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{member_id}')
+
+
+    async def edit(self, content: str=None, **kwargs) -> 'FakeMessage':
+        await self.channel.guild.rest.call('PATCH /channels/{channel_id}/messages/{message_id}')
+        self.content = content
+        return self
+
+
+    async def pin(self) -> None:
+        await self.channel.guild.rest.call('PUT /channels/{channel_id}/pins/{message_id}')
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, name: str, guild, overwrites: dict=None):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.overwrites = overwrites or dict()
+        self.sent = 0
+
+
+    async def send(self, content: str=None, **kwargs) -> FakeMessage:
+        await self.guild.rest.call('POST /channels/{channel_id}/messages')
+        self.sent += 1
+        return FakeMessage(self.guild.rest.next_id(), self, content)
+
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return FakeMessage(message_id, self)
+
+
+    async def set_permissions(self, target, overwrite=None, **kwargs) -> None:
+        await self.guild.rest.call('PUT /channels/{channel_id}/permissions/{overwrite_id}')
+        if overwrite is None:
+            self.overwrites.pop(target, None)
+        else:
+            self.overwrites[target] = overwrite
+
+
+class FakeGuild:
+    '''
+    a guild with a competitor role, an Organizers role, the channels the bot
+    is configured with, and whatever channels the bot creates
+    '''
+
+    def __init__(self, usernames: list, rest: FakeREST):
+        self.id = GUILD_ID
+        self.rest = rest
+        self.default_role = FakeRole(GUILD_ID, '@everyone')
+        self.competitors = FakeRole(COMPETITOR_ROLE_ID, 'Competitors')
+        self.organizers = FakeRole(ORGANIZER_ROLE_ID, 'Organizers')
+        self.roles = [self.default_role, self.competitors, self.organizers]
+
+        self.me = FakeMember(rest.next_id(), 'hackor-bot', self, [self.default_role])
+        self.me.bot = True
+        self._members = {self.me.id: self.me}
+        for username in usernames:
+            roles = [self.default_role, self.organizers if username == ORGANIZER else self.competitors]
+            member = FakeMember(rest.next_id(), username, self, roles)
+            self._members[member.id] = member
+        self.by_name = {member.name: member for member in self._members.values()}
+
+        self._channels = dict()
+        for channel_id, name in ((REQUESTS_CHANNEL_ID, 'team-requests'), (MAKETEAMS_CHANNEL_ID, 'maketeams'), (SPECIALIZATIONS_CHANNEL_ID, 'specializations')):
+            self._channels[channel_id] = FakeChannel(channel_id, name, self)
+
+
+    @property
+    def members(self) -> list:
+        return list(self._members.values())
+
+
+    @property
+    def channels(self) -> list:
+        return list(self._channels.values())
+
+
+    def get_member(self, member_id: int) -> FakeMember:
+        return self._members.get(member_id)
+
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        return self._channels.get(channel_id)
+
+
+    async def fetch_channel(self, channel_id: int) -> FakeChannel:
+        await self.rest.call('GET /channels/{channel_id}')
+        return self._channels[channel_id]
+
+
+    async def fetch_user(self, user_id: int) -> FakeMember:
+        await self.rest.call('GET /users/{user_id}')
+        return self._members[user_id]
+
+
+    async def create_category(self, name: str, **kwargs) -> FakeChannel:
+        await self.rest.call('POST /guilds/{guild_id}/channels')
+        category = FakeChannel(self.rest.next_id(), name, self)
+        self._channels[category.id] = category
+        return category
+
+
+    async def create_text_channel(self, name: str, category: FakeChannel=None, topic: str=None, overwrites: dict=None, **kwargs) -> FakeChannel:
+        await self.rest.call('POST /guilds/{guild_id}/channels')
+        channel = FakeChannel(self.rest.next_id(), name, self, overwrites)
+        self._channels[channel.id] = channel
+        return channel
+
+
+class FakeContext:
+    '''
+    just enough of a commands.Context for the bot's commands
+    '''
+
+    def __init__(self, guild: FakeGuild, channel: FakeChannel, author: FakeMember, content: str):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage(guild.rest.next_id(), channel, content)
+        self.bot = None
+
+
+    async def send(self, content: str=None, **kwargs) -> FakeMessage:
+        # same signature as discord.py's, so a bad call fails here too
+        return await self.channel.send(content, **kwargs)
+
+
+def generate_trace(num_users: int, duration: float=300, seed: int=None, lock_ratio: float=0.5, typo_ratio: float=0.02, maketeams: bool=True) -> list:
+    '''
+    a scripted event start: num_users competitors (see
+    bench.generate_users()) pick their specialities with reactions and send
+    their !request at random times within `duration` seconds, lock_ratio of
+    the fully mutual groups then !lock-team, typo_ratio of the requested
+    names are mistyped, and an organizer runs !maketeams at the end.
+
+    events are dicts with the time 't' in seconds, the 'user' and either a
+    'command' with its 'args' or a 'reaction' emoji name (a key of
+    SPECIALITY_EMOJIS)
+    '''
+    rng = random.Random(seed)
+    users = bench.generate_users(num_users, seed)
+    emoji_names = {speciality: name for name, speciality in SPECIALITY_EMOJIS.items()}
+
+    trace = list()
+    requested_at = dict()
+    for user in users:
+        for speciality in user['specialities'] + (['noob'] if user['noob'] else []):
+            trace.append({'t': rng.uniform(0, duration), 'user': user['username'], 'reaction': emoji_names[speciality]})
+
+        if user['team_requests']:
+            args = [('@' if rng.random() < 0.3 else '') + username for username in user['team_requests']]
+            args = [x + 'x' if rng.random() < typo_ratio else x for x in args]
+            requested_at[user['username']] = rng.uniform(0, duration * 0.9)
+            trace.append({'t': requested_at[user['username']], 'user': user['username'], 'command': 'request', 'args': args})
+
+    # someone in a mutual group locks it once everyone has requested
+    for group in teamutil.contract_mutual_groups(users):
+        if len(group) > 1 and rng.random() < lock_ratio:
+            usernames = [users[i]['username'] for i in group]
+            last = max(requested_at[x] for x in usernames)
+            trace.append({'t': min(last + rng.uniform(1, 30), duration), 'user': rng.choice(usernames), 'command': 'lock-team', 'args': []})
+
+    if maketeams:
+        trace.append({'t': duration + 1, 'user': ORGANIZER, 'command': 'maketeams', 'args': ['new']})
+
+    trace.sort(key=lambda event: event['t'])
+    return trace
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class _StallMonitor:
+    '''
+    wakes up every `interval` seconds and adds up how late it was, which is
+    how long something kept the event loop busy
+    '''
+
+    def __init__(self, interval: float=0.01, threshold: float=0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = list()
+        self._task = None
+
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            late = loop.time() - expected
+            if late >= self.threshold:
+                self.stalls.append(late)
+
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+
+    def stop(self) -> None:
+        self._task.cancel()
+
+
+    def report(self) -> dict:
+        return {
+            'stalls': len(self.stalls),
+            'stall_seconds': sum(self.stalls),
+            'max_stall_seconds': max(self.stalls, default=0.0),
+            'p99_stall_seconds': _percentile(self.stalls, 0.99)
+        }
+
+
+def _config(maketeams_budget: float) -> dict:
+    return {
+        'discord': {
+            'competitor-id': COMPETITOR_ROLE_ID,
+            'specializations': {
+                'channel-id': SPECIALIZATIONS_CHANNEL_ID,
+                'message-id': SPECIALIZATIONS_MESSAGE_ID,
+                'emojis': dict(SPECIALITY_EMOJIS)
+            },
+            'team-requests': {'channel-id': REQUESTS_CHANNEL_ID},
+            'maketeams': {
+                'channel-id': MAKETEAMS_CHANNEL_ID,
+                'time-budget': maketeams_budget,
+                'progress-interval': 1
+            }
+        },
+        'stats': {}
+    }
+
+
+async def _replay(main, trace: list, guild: FakeGuild, time_scale: float, monitor: _StallMonitor) -> dict:
+    emojis = {name: emoji for emoji, name in ((emoji, main._emoji_to_name(emoji)) for emoji in main._emoji_specialities)}
+    latencies = dict() # command or 'reaction' => seconds
+    errors = dict()
+
+    async def run(event: dict) -> None:
+        author = guild.by_name[event['user']]
+        if 'reaction' in event:
+            name = 'reaction'
+            emoji = emojis.get(event['reaction'], event['reaction'])
+            payload = types.SimpleNamespace(message_id=SPECIALIZATIONS_MESSAGE_ID, channel_id=SPECIALIZATIONS_CHANNEL_ID, guild_id=GUILD_ID, user_id=author.id, member=author, emoji=types.SimpleNamespace(name=emoji))
+            coroutine = main.on_raw_reaction_add(payload)
+        else:
+            name = event['command']
+            channel = guild.get_channel(MAKETEAMS_CHANNEL_ID if name == 'maketeams' else REQUESTS_CHANNEL_ID)
+            ctx = FakeContext(guild, channel, author, ' '.join(['!' + name] + event['args']))
+            coroutine = main.client.get_command(name)(ctx, *event['args'])
+
+        start_time = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            logging.exception('loadtest: %s by %s failed', name, event['user'])
+            errors[name] = errors.get(name, 0) + 1
+        latencies.setdefault(name, list()).append(time.perf_counter() - start_time)
+
+    loop = asyncio.get_running_loop()
+    main.db.start_flusher()
+    monitor.start()
+
+    start_time = loop.time()
+    tasks = list()
+    for event in trace:
+        delay = start_time + event['t'] * time_scale - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(run(event)))
+    await asyncio.gather(*tasks)
+
+    monitor.stop()
+    main.db.flush()
+    return {
+        name: {
+            'count': len(values),
+            'errors': errors.get(name, 0),
+            'p50_seconds': _percentile(values, 0.5),
+            'p99_seconds': _percentile(values, 0.99),
+            'max_seconds': max(values)
+        }
+        for name, values in sorted(latencies.items())
+    }
+
+
+def replay(trace: list, time_scale: float=1.0, latency: float=0.05, rate_limit_ratio: float=0.0, retry_after: float=1.0, maketeams_budget: float=5, seed: int=None, workdir: str=None) -> dict:
+    '''
+    plays a trace (see generate_trace()) against the real command and event
+    handlers in main, in a fake guild whose API calls go to a FakeREST.
+    time_scale stretches the trace (0.1 plays it 10x faster). the db lives
+    in workdir (a temporary directory that's removed afterwards by default).
+
+    returns the latency of each command, what the db and the fake api did,
+    and how long the event loop was stalled
+    '''
+    cwd = os.getcwd()
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='hackor-loadtest-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    try:
+        # anything the bot prints would end up in the middle of the json
+        with contextlib.redirect_stdout(sys.stderr):
+            import main
+
+            # the log file has everything, the console only problems
+            logutil.setup({'level': 'DEBUG', 'console-level': 'ERROR'})
+            main.config = _config(maketeams_budget)
+            main._load_emoji_table()
+            main.db.read()
+
+            rest = FakeREST(latency, rate_limit_ratio, retry_after, random.Random(seed))
+            usernames = sorted({event['user'] for event in trace} | {ORGANIZER})
+            guild = FakeGuild(usernames, rest)
+            main.client.fetch_user = guild.fetch_user
+            main.client.fetch_channel = guild.fetch_channel
+            main.client.get_channel = guild.get_channel
+            # what on_ready does with a real guild
+            main.member_index.warm(guild.members)
+            main.competitor_index.role_id = COMPETITOR_ROLE_ID
+            main.competitor_index.warm(guild.members)
+
+            monitor = _StallMonitor()
+            db_before = dict(main.db.metrics)
+            start_time = time.perf_counter()
+            commands = asyncio.run(_replay(main, trace, guild, time_scale, monitor))
+            wall_time = time.perf_counter() - start_time
+            main.db.close()
+    finally:
+        logutil.shutdown()
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'users': len(usernames) - 1,
+        'events': len(trace),
+        'time_scale': time_scale,
+        'latency': latency,
+        'rate_limit_ratio': rate_limit_ratio,
+        'wall_seconds': wall_time,
+        'commands': commands,
+        'api': {
+            'calls': sum(rest.calls.values()),
+            'rate_limited': rest.rate_limited,
+            'routes': dict(sorted(rest.calls.items(), key=lambda x: -x[1]))
+        },
+        'db': {name: value - db_before[name] for name, value in main.db.metrics.items() if name != 'flush_seconds_max'} | {'flush_seconds_max': main.db.metrics['flush_seconds_max']},
+        'loop': monitor.report()
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replays an event start against the bot\'s commands in a fake guild (no network) and prints latencies, db writes and event loop stalls as json')
+    parser.add_argument('--users', type=int, default=2000, help='competitors in the generated trace')
+    parser.add_argument('--duration', type=float, default=300, help='seconds the generated trace is spread over')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lock-ratio', type=float, default=0.5, help='share of mutual groups that !lock-team')
+    parser.add_argument('--no-maketeams', action='store_true', help='leave !maketeams out of the generated trace')
+    parser.add_argument('--trace', help='replay this jsonl trace instead of generating one')
+    parser.add_argument('--save-trace', help='write the trace here as jsonl')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='stretch the trace, 0.1 plays it 10x faster')
+    parser.add_argument('--latency', type=float, default=0.05, help='median seconds per api call')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.01, help='share of api calls that get a 429 first')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='seconds to wait after a 429')
+    parser.add_argument('--maketeams-budget', type=float, default=5, help='optimizer seconds for !maketeams')
+    parser.add_argument('--workdir', help='keep the db and log here instead of a temporary directory')
+    parser.add_argument('--output', '-o', help='write the json here instead of stdout')
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = [json.loads(line) for line in f if line.strip()]
+    else:
+        trace = generate_trace(args.users, args.duration, args.seed, args.lock_ratio, maketeams=not args.no_maketeams)
+
+    if args.save_trace:
+        with open(args.save_trace, 'w') as f:
+            f.writelines(json.dumps(event) + '\n' for event in trace)
+
+    report = replay(trace, args.time_scale, args.latency, args.rate_limit_ratio, args.retry_after, args.maketeams_budget, args.seed, os.path.abspath(args.workdir) if args.workdir else None)
+    for name, result in report['commands'].items():
+        print('[ ] %s: %d, p50 %.3fs, p99 %.3fs, %d errors' % (name, result['count'], result['p50_seconds'], result['p99_seconds'], result['errors']), file=sys.stderr)
+    print('[ ] %d api calls (%d rate limited), %d db writes, event loop stalled %.2fs (max %.3fs)' % (report['api']['calls'], report['api']['rate_limited'], report['db']['writes'], report['loop']['stall_seconds'], report['loop']['max_stall_seconds']), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import logging.handlers
+import queue
+import reprlib
+import sys
+import time
+
+
+# loggers that are too chatty below these levels, config.yml can override them
+DEFAULT_LEVELS = {
+    'discord': 'WARNING',
+    'asyncio': 'WARNING'
+}
+
+# attributes every LogRecord has, anything else came from extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    one json object per line: time, level, logger, thread, message, the
+    exception if there was one, and anything passed with extra=
+    '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''
+    a QueueHandler that keeps the traceback apart from the message, so the
+    json file gets it as its own field
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formats the message here, while the arguments are still what they
+        # were when it was logged
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+
+        record = logging.makeLogRecord(vars(record))
+        record.message = record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+
+_summary_repr = reprlib.Repr()
+_summary_repr.maxlevel = 3
+_summary_repr.maxlist = _summary_repr.maxtuple = _summary_repr.maxset = _summary_repr.maxdict = 5
+_summary_repr.maxstring = _summary_repr.maxother = 80
+
+
+class Summary:
+    '''
+    stands in for a big structure in a log call: it formats as its size and
+    the first few items, and only if the record actually gets written
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+    def __str__(self) -> str:
+        if isinstance(self.value, (list, tuple, set, frozenset, dict)):
+            return '(%d) %s' % (len(self.value), _summary_repr.repr(self.value))
+        return _summary_repr.repr(self.value)
+
+    __repr__ = __str__
+
+
+def summarize(value) -> Summary:
+    '''
+    e.g. logging.info('teams: %s', summarize(teams))
+    '''
+    return Summary(value)
+
+
+_listener = None
+
+def setup(settings: dict=None) -> None:
+    '''
+    sends every record through a queue to a background thread, which writes
+    them as text to stdout and as json lines to a file that's rotated by
+    size, so logging never waits on the disk or the terminal. settings is
+    the `logging` section of config.yml: 'level' (of the root logger),
+    'levels' (per logger), 'console-level', 'file' (None for no file),
+    'max-bytes' and 'backups'. calling it again replaces the old setup
+    '''
+    settings = settings or dict()
+    shutdown()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(settings.get('console-level', 'INFO'))
+    console.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    handlers = [console]
+
+    path = settings.get('file', 'hackor-bot.log')
+    if path:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=settings.get('max-bytes', 10 * 1024 * 1024), backupCount=settings.get('backups', 5), encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(settings.get('level', 'INFO'))
+    for name, level in (DEFAULT_LEVELS | settings.get('levels', dict())).items():
+        logging.getLogger(name).setLevel(level)
+
+    global _listener
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown() -> None:
+    '''
+    writes out whatever is still queued and closes the handlers
+    '''
+    global _listener
+    if _listener is None:
+        return
+
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
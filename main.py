@@ -9,27 +9,25 @@ import json
 import logging
 import unicodedata
 import time
-import sys
+import random
+import asyncio
+import functools
+import multiprocessing
+import signal
+import cProfile
+import pstats
+import io
 
 import db
 import teamutil
+import memberutil
+import metrics
+import logutil
 
-root = logging.getLogger()
-root.setLevel(logging.DEBUG)
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-root.addHandler(handler)
-fh = logging.FileHandler('hackor-bot.log')
-fh.setFormatter(formatter)
-root.addHandler(fh)
-
-_logger = logging.getLogger('discord')
-_logger.setLevel(logging.WARNING)
-
-_logger = logging.getLogger('asyncio')
-_logger.setLevel(logging.WARNING)
+# logging is set up from config.yml once it's read, see logutil.setup().
+# log with arguments rather than formatting the message first, and wrap
+# anything big in logutil.summarize(), so disabled levels cost nothing and
+# enabled ones don't dump megabytes from the event loop
 
 intents = discord.Intents.default()
 intents.reactions = True
@@ -45,34 +43,89 @@ TESTING_MODE = False
 ##########
 
 
-_user_cache = dict()
+bot_metrics = metrics.Registry()
+_started = time.time()
+_last_optimizer_stats = None # TeamOptimizer.stats() of the last !maketeams
+
+
+@client.before_invoke
+async def _before_command(ctx: discord.ext.commands.context.Context) -> None:
+    ctx.started = time.perf_counter()
+
+
+@client.after_invoke
+async def _after_command(ctx: discord.ext.commands.context.Context) -> None:
+    # discord.py calls this whether or not the command raised
+    command = ctx.command.qualified_name
+    bot_metrics.observe('bot_command_seconds', time.perf_counter() - ctx.started, {'command': command}, help='time to run each command')
+    bot_metrics.inc('bot_commands_total', {'command': command, 'failed': str(ctx.command_failed).lower()}, help='commands run')
+
+
+# count every discord api request, by route template (not the filled in
+# path, that would be a new label for every channel)
+_http_request = client.http.request
+
+async def _counted_request(route: discord.http.Route, **kwargs):
+    bot_metrics.inc('discord_api_requests_total', {'method': route.method, 'route': route.path}, help='discord api requests made')
+    return await _http_request(route, **kwargs)
+
+client.http.request = _counted_request
+
+
+##########
+
+
+member_index = memberutil.MemberIndex()
+# who requested whom, kept in step with db.db['users'] by !request
+request_graph = teamutil.RequestGraph()
+_member_converter = discord.ext.commands.MemberConverter()
 '''
 resolves a username to a discord.member.Member object
 '''
-async def resolve_user(ctx: discord.ext.commands.context.Context, user: str, use_cache: bool=False) -> discord.member.Member:
+async def resolve_user(ctx: discord.ext.commands.context.Context, user: str) -> discord.member.Member:
     assert isinstance(user, str)
 
-    converter = discord.ext.commands.MemberConverter() # XXX: should I move this to the global scope?
-    member = _user_cache.get(user)
-    if (not use_cache) or not member:
-        try:
-            member = await converter.convert(ctx, user)
-        except discord.ext.commands.errors.MemberNotFound:
-            member = None
+    # the index is kept current from member events, so once it's warm it
+    # knows everyone and a miss means there's no such member. unless it's
+    # had to drop some to stay under member-cache.max-size, then the
+    # converter has the final say
+    member = member_index.get(user)
+    if member or (member_index.warmed and not member_index.trimmed):
+        return member
 
-        if (not member) and user.startswith('@'):
-            member = await resolve_user(ctx, user[1:], use_cache=use_cache)
+    try:
+        member = await _member_converter.convert(ctx, user)
+    except discord.ext.commands.errors.MemberNotFound:
+        member = None
 
-        if member:
-            _user_cache[user] = member
+    if (not member) and user.startswith('@'):
+        member = await resolve_user(ctx, user[1:])
+
+    if member:
+        member_index.add(member)
 
     return member
 
 
+# everyone with the competitor role, warmed in on_ready and kept current from
+# member events
+competitor_index = memberutil.RoleIndex()
+'''
+checks whether a member has the competitor role
+'''
+def is_competitor(member: discord.member.Member) -> bool:
+    if competitor_index.warmed:
+        return member.id in competitor_index
+    return config['discord']['competitor-id'] in [x.id for x in member.roles]
+
+
 '''
 creates a set of discord.member.Member who are competitors
 '''
 async def get_competitors(ctx: discord.ext.commands.context.Context) -> typing.Set[discord.member.Member]:
+    if competitor_index.warmed:
+        return set(competitor_index.members())
+
     competitors = set(discord.utils.get(ctx.guild.roles, id=config['discord']['competitor-id']).members)
     return competitors
 
@@ -84,10 +137,10 @@ def _get_db_user_from_user(user: discord.member.Member) -> dict:
     uid = str(user)
 
     assert 'users' in db.db
-    logging.debug('_get_db_user_from_user: fetching db user: %r' % uid)
+    logging.debug('_get_db_user_from_user: fetching db user: %r', uid)
     if uid not in db.db['users']:
         db.db['users'][uid] = dict()
-        db.write()
+        db.write(uid)
 
     return db.db['users'][uid]
 
@@ -108,31 +161,222 @@ def _emoji_to_name(emoji: str) -> str:
     return unicodedata.name(emoji).lower().replace(' ', '_').replace('symbol_letter_', '')
 
 
+# emoji => speciality (or None for meaningless emojis), see _load_emoji_table()
+_emoji_specialities = dict()
+'''
+fills _emoji_specialities from the config names, so reactions don't need a
+unicode name lookup. call whenever config is (re)loaded
+'''
+def _load_emoji_table() -> None:
+    _emoji_specialities.clear()
+    for name, speciality in config['discord']['specializations']['emojis'].items():
+        # undo _emoji_to_name(): letters had "symbol letter" taken out
+        words = name.upper().split('_')
+        for unicode_name in (' '.join(words), ' '.join(words[:-1] + ['SYMBOL', 'LETTER'] + words[-1:])):
+            try:
+                _emoji_specialities[unicodedata.lookup(unicode_name)] = speciality
+                break
+            except KeyError:
+                pass
+        else:
+            logging.warning('no emoji found for %r, it will be looked up when someone uses it', name)
+
+
+'''
+the speciality an emoji stands for, or None. emojis not in the table yet are
+looked up once and remembered
+'''
+def _emoji_to_speciality(emoji: str) -> str:
+    try:
+        return _emoji_specialities[emoji]
+    except KeyError:
+        pass
+
+    try:
+        speciality = config['discord']['specializations']['emojis'].get(_emoji_to_name(emoji))
+    except (TypeError, ValueError):
+        # custom emojis (a name, not a character) and characters without a
+        # unicode name never mean anything
+        speciality = None
+    _emoji_specialities[emoji] = speciality
+    return speciality
+
+
 ##########
 
 
 @client.event
 async def on_ready() -> None:
-    logging.info(f'{client.user} has connected to Discord!')
+    logging.info('%s has connected to Discord!', client.user)
+
+    # persist db writes in the background from now on, and get them onto
+    # disk before exiting on SIGTERM
+    db.start_flusher()
+
+    # we have the members intent, so discord.py already has every member
+    member_cache_config = config['discord'].get('member-cache', {})
+    member_index.max_size = member_cache_config.get('max-size', member_index.max_size)
+    member_index.ttl = member_cache_config.get('ttl', member_index.ttl)
+    competitor_index.role_id = config['discord']['competitor-id']
+    for guild in client.guilds:
+        member_index.warm(guild.members)
+        competitor_index.warm(guild.members)
+    logging.info('indexed %d members, %d competitors', len(member_index), len(competitor_index))
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(client.close()))
+    except NotImplementedError:
+        pass # windows
     await client.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name='your requests'))
 
+    global _metrics_writer
+    if config.get('stats', {}).get('prometheus-file') and not _metrics_writer:
+        _metrics_writer = asyncio.create_task(_write_metrics_periodically())
+
+    try:
+        await _reconcile_specialities()
+    except discord.HTTPException as e:
+        logging.error('unable to reconcile specialities: %s', e)
+
+
+@client.event
+async def on_member_join(member: discord.member.Member) -> None:
+    member_index.add(member)
+    competitor_index.add(member)
+
+
+@client.event
+async def on_member_remove(member: discord.member.Member) -> None:
+    member_index.remove(member)
+    competitor_index.remove(member)
+
+
+@client.event
+async def on_member_update(before: discord.member.Member, after: discord.member.Member) -> None:
+    # role changes come through here too
+    member_index.update(before, after)
+    competitor_index.update(before, after)
+
+
+@client.event
+async def on_user_update(before: discord.User, after: discord.User) -> None:
+    # username changes come as user updates, re-index the member objects
+    for guild in client.guilds:
+        if member := guild.get_member(after.id):
+            member_index.update(member, member)
+            competitor_index.update(member, member)
+
+
+'''
+adds or removes a speciality on the user's db entry. specialities are kept
+current from reaction events, so maketeams never has to read the reactions
+'''
+def _set_speciality(user: discord.abc.User, speciality: str, present: bool) -> None:
+    if _reconciling_specialities is not None:
+        # the startup scan will overwrite this user, so replay it after
+        _reconciling_specialities.append((user, speciality, present))
+
+    user_dict = _get_db_user_from_user(user)
+    specialities = user_dict.setdefault('specialities', list())
+    if present and speciality not in specialities:
+        specialities.append(speciality)
+    elif not present and speciality in specialities:
+        specialities.remove(speciality)
+    else:
+        return
+
+    db.write(str(user))
+
 
+# events that came in while _reconcile_specialities() was scanning, or None
+_reconciling_specialities = None
+_specialities_reconciled = False
+'''
+catches up on reactions added or removed while the bot was offline by reading
+the specializations message once
+'''
+async def _reconcile_specialities() -> None:
+    global _reconciling_specialities, _specialities_reconciled
+    if _specialities_reconciled or _reconciling_specialities is not None:
+        return
+
+    _reconciling_specialities = list()
+    try:
+        channel = client.get_channel(int(config['discord']['specializations']['channel-id'])) or await client.fetch_channel(int(config['discord']['specializations']['channel-id']))
+        msg = await channel.fetch_message(int(config['discord']['specializations']['message-id']))
+
+        # parse reactions => specialities
+        specialities = dict()
+        for reaction in msg.reactions:
+            # if the emoji is meaningless, skip it
+            if not (speciality := _emoji_to_speciality(str(reaction.emoji))):
+                continue
+
+            async for user in reaction.users(limit=None, after=None):
+                user_specialities = specialities.setdefault(str(user), list())
+                if speciality not in user_specialities:
+                    user_specialities.append(speciality)
+
+        for username, details in db.db['users'].items():
+            details['specialities'] = specialities.pop(username, list())
+        for username, user_specialities in specialities.items():
+            db.db['users'][username] = {'specialities': user_specialities}
+        db.write()
+
+        # anything that happened during the scan wins over it
+        events = _reconciling_specialities
+        _reconciling_specialities = None
+        for user, speciality, present in events:
+            _set_speciality(user, speciality, present)
+
+        _specialities_reconciled = True
+        logging.info('reconciled specialities from %d reactions', sum(reaction.count for reaction in msg.reactions))
+    finally:
+        _reconciling_specialities = None
+
+
+# how many reaction events were handled from the gateway payload alone vs
+# needed an API call
+reaction_stats = {'fast': 0, 'slow': 0}
 @client.event
 async def on_raw_reaction_add(payload: discord.raw_models.RawReactionActionEvent) -> None:
     if payload.message_id == config['discord']['specializations']['message-id']:
-        channel = await client.fetch_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        user = await client.fetch_user(payload.user_id)
         emoji = payload.emoji
+        tag = _emoji_to_speciality(emoji.name)
+
+        if tag and payload.member:
+            # the common case: nothing to ask discord about
+            reaction_stats['fast'] += 1
+            _set_speciality(payload.member, tag, True)
+            return
 
-        name = _emoji_to_name(emoji.name)
+        reaction_stats['slow'] += 1
         try:
-            tag = config['discord']['specializations']['emojis'].get(name)
             if not tag:
-                logging.debug(f'Removing meaningless emoji "{name}" ({emoji.name})')
-                await message.remove_reaction(emoji, payload.member)
+                logging.debug('Removing meaningless emoji "%s"', emoji.name)
+                channel = client.get_channel(payload.channel_id) or await client.fetch_channel(payload.channel_id)
+                await channel.get_partial_message(payload.message_id).remove_reaction(emoji, payload.member or discord.Object(payload.user_id))
+            else:
+                _set_speciality(await client.fetch_user(payload.user_id), tag, True)
         except Exception as e:
-            logging.error('when adding reaction: ' + str(e))
+            logging.error('when adding reaction: %s', e)
+
+
+@client.event
+async def on_raw_reaction_remove(payload: discord.raw_models.RawReactionActionEvent) -> None:
+    if payload.message_id == config['discord']['specializations']['message-id']:
+        if not _emoji_to_speciality(payload.emoji.name):
+            return
+
+        # removals don't come with a member, but we know everyone
+        user = member_index.get_by_id(payload.user_id) or client.get_user(payload.user_id)
+        if user:
+            reaction_stats['fast'] += 1
+        else:
+            reaction_stats['slow'] += 1
+            user = await client.fetch_user(payload.user_id)
+
+        if tag := _emoji_to_speciality(payload.emoji.name):
+            _set_speciality(user, tag, False)
 
 
 ##########
@@ -153,7 +397,7 @@ async def request(ctx: discord.ext.commands.context.Context, *args) -> None:
             await ctx.send('**Error:** Cannot request when a team is locked. Please unlock with `!unlock-team` if you\'d like. Your currently-locked team is: `' + ' '.join(list({str(ctx.author)} | set(_get_db_user_from_ctx(ctx).get('team_requests', [])))) + '`', **msg_settings)
             return False
 
-        if config['discord']['competitor-id'] not in [x.id for x in ctx.author.roles]:
+        if not is_competitor(ctx.author):
             await ctx.send('**Error:** Only competitors may use `!request`.', **msg_settings)
             return False
 
@@ -171,7 +415,7 @@ async def request(ctx: discord.ext.commands.context.Context, *args) -> None:
                     continue
 
                 # check to make sure requested user has the right role
-                if config['discord']['competitor-id'] not in [x.id for x in user.roles]:
+                if not is_competitor(user):
                     _users_unauthorized.append(username)
                     continue
                 
@@ -179,7 +423,8 @@ async def request(ctx: discord.ext.commands.context.Context, *args) -> None:
 
         # don't do `if _users_found` because we want "!maketeams" (without args) to reset this
         author_user['team_requests'] = _users_found
-        db.write()
+        request_graph.set_requests(str(ctx.author), _users_found)
+        db.write(str(ctx.author))
 
         res_msg = 'Resetting your requested users...'
         if _users_found:
@@ -204,35 +449,28 @@ async def request(ctx: discord.ext.commands.context.Context, *args) -> None:
 
 async def _set_team_locked(ctx, locked: bool) -> bool:
     author = _get_db_user_from_ctx(ctx)
-    logging.debug('_set_team_locked: author=%r, locked=%r' % (author, locked))
+    logging.debug('_set_team_locked: author=%r, locked=%r', author, locked)
     if author.get('lock_team', False) == locked:
         await ctx.send('**Error:** Your team is already locked to the users: ' + ' '.join(list({str(ctx.author)} | set(_get_db_user_from_ctx(ctx).get('team_requests', [])))) + '. You may unlock your team by running the command `!unlock-team`.', **msg_settings)
         return False
 
-    tags = set(author.get('team_requests', [])) | {str(ctx.author)}
-    logging.debug('_set_team_locked: all tags: %r' % tags)
+    tags = request_graph.group(str(ctx.author))
+    logging.debug('_set_team_locked: all tags: %r', tags)
 
-    problems = dict()
-    for tag in tags:
-        user = _get_db_user_from_user(tag)
-        # make sure users requested each other
-        if set(user.get('team_requests', [])) | {tag} != tags:
-            problems[tag] = {
-                'requested': list(set(user.get('team_requests', []))),
-                'should_request': list(tags - {tag})
-            }
+    # make sure users requested each other
+    problems = request_graph.group_problems(str(ctx.author))
 
-    logging.debug('_set_team_locked: problems: %r' % problems)
+    logging.debug('_set_team_locked: problems: %r', problems)
     if problems:
         if locked:
             teammates_msg = list()
             # we're trying to lock the team
 
             for tag, data in problems.items():
-                member_obj = await resolve_user(ctx, tag, use_cache=True)
+                member_obj = await resolve_user(ctx, tag)
                 if not member_obj:
                     # don't exit, just warn
-                    logging.warning('_set_team_locked: Unable to find member object for member %r %r!' % (tag, data))
+                    logging.warning('_set_team_locked: Unable to find member object for member %r %r!', tag, data)
                     continue
                 
                 teammates_msg.append('  *  ' + member_obj.mention + ': `!request ' + ' '.join(data['should_request']) + '` (currently requested: ' + (' '.join(data['requested']) or 'none') + ')')
@@ -241,15 +479,16 @@ async def _set_team_locked(ctx, locked: bool) -> bool:
             return False
         else:
             # we're trying to reset the lock
-            await ctx.send(ctx, 'It looks like the user(s) you requested, %s, is/are not a part of your team.' % (' '.join(str(x) for x in problems.keys())), **msg_settings)
+            await ctx.send('It looks like the user(s) you requested, %s, is/are not a part of your team.' % (' '.join(str(x) for x in problems.keys())), **msg_settings)
             return False
 
 
+    # everyone in a fully mutual group has requested someone, so they're
+    # already in the db
     for tag in tags:
-        user = _get_db_user_from_user(tag)
-        user['lock_team'] = locked
+        db.db['users'][tag]['lock_team'] = locked
 
-    db.write()
+    db.write(*tags)
     return True
 
 
@@ -258,7 +497,7 @@ async def lockteam(ctx: discord.ext.commands.context.Context, *args) -> None:
     if ctx.channel.id == config['discord']['team-requests']['channel-id']:
         num_teammates_requested = len(_get_db_user_from_ctx(ctx).get('team_requests', []))
         if num_teammates_requested >= 4:
-            await ctx.send(ctx, '**Error:** You requested %d teammates, but the maximum team size is 4. Use `!request [usernames...]` to request up to 3 other people to be on your team.' % num_teammates_requested, **msg_settings)
+            await ctx.send('**Error:** You requested %d teammates, but the maximum team size is 4. Use `!request [usernames...]` to request up to 3 other people to be on your team.' % num_teammates_requested, **msg_settings)
             return 
 
         if await _set_team_locked(ctx, True):
@@ -279,126 +518,641 @@ async def unlockteam(ctx: discord.ext.commands.context.Context, *args) -> None:
             await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
 
-MAKETEAMS_LOCK = False
+class MaketeamsJob:
+    '''
+    handle for the running !maketeams, so it can be queried with
+    `!maketeams status` and cancelled with `!maketeams cancel`
+    '''
+
+    def __init__(self, ctx: discord.ext.commands.context.Context):
+        self.ctx = ctx
+        self.started = time.time()
+        self.stage = 'starting'
+        self.cancelled = False
+        self.time_budget = None
+        self.optimizer = None # set when optimizing in this process
+        self.stop_event = None # set when optimizing with parallel chains or shards
+        self.profilers = list() # when maketeams.profile is set
+
+
+    def cancel(self) -> None:
+        # the optimizer returns early and the job stops at the next stage
+        self.cancelled = True
+        if self.optimizer:
+            self.optimizer.stop()
+        if self.stop_event:
+            self.stop_event.set()
+
+
+    def status(self) -> str:
+        if self.stage != 'optimizing':
+            return 'Team generation in progress: %s (%ds elapsed).' % (self.stage, time.time() - self.started)
+
+        if self.optimizer:
+            progress = self.optimizer.progress()
+        else:
+            # parallel chains and shards run in other processes, all we know is the clock
+            elapsed = time.time() - self.started
+            progress = {'iterations': None, 'elapsed': elapsed, 'eta': max(self.time_budget - elapsed, 0) if self.time_budget else None}
+
+        msg = 'Generating optimized teams'
+        if progress['iterations'] is not None:
+            msg += ': best score %.1f, %d swaps tried (%d/s)' % (progress['best_score'], progress['iterations'], progress['iterations_per_second'])
+        if progress['eta'] is not None:
+            msg += ', about %.0fs left' % progress['eta']
+        else:
+            msg += ', running until no more improvements are found'
+        return msg + '...'
+
+
+_maketeams_job = None
 @client.command(pass_context=True)
 async def maketeams(ctx: discord.ext.commands.context.Context, *args) -> None:
-    global MAKETEAMS_LOCK
+    global _maketeams_job
 
-    if MAKETEAMS_LOCK:
-        await ctx.send('Team generation already in progress, ignoring additional request...', **msg_settings)
+    if ctx.channel.id != config['discord']['maketeams']['channel-id']:
+        await ctx.send('Wrong channel.', **msg_settings) # we use message send permission in channels for access control
         return
 
-    MAKETEAMS_LOCK = True
+    if args and args[0] in ('status', 'cancel'):
+        if not _maketeams_job:
+            await ctx.send('No team generation in progress.', **msg_settings)
+        elif args[0] == 'status':
+            await ctx.send(_maketeams_job.status(), **msg_settings)
+        else:
+            _maketeams_job.cancel()
+            await ctx.send('Cancelling team generation...', **msg_settings)
+        return
 
-    if ctx.channel.id == config['discord']['maketeams']['channel-id']:
-        channel = ctx.guild.get_channel(int(config['discord']['specializations']['channel-id']))
-        msg = await channel.fetch_message(int(config['discord']['specializations']['message-id']))
+    if _maketeams_job:
+        await ctx.send('Team generation already in progress, ignoring additional request... (use `!maketeams status` or `!maketeams cancel`)', **msg_settings)
+        return
 
-        # reset specialities
-        for username in db.db['users']:
-            if 'specialities' in db.db['users'][username]:
-                del db.db['users'][username]['specialities']
+    # !maketeams new [seed] [iterations] re-generates the teams of an earlier run
+    seed = max_iterations = None
+    try:
+        if len(args) > 1 and args[0] == 'new':
+            seed = int(args[1])
+        if len(args) > 2 and args[0] == 'new':
+            max_iterations = int(args[2])
+    except ValueError:
+        await ctx.send('**Error:** Usage: `!maketeams new [seed] [iterations]`', **msg_settings)
+        return
 
-        #  get_competitors() and make sure they all exist in the db
-        for user in await get_competitors(ctx):
-            username = str(user)
-            if username not in db.db['users']:
-                db.db['users'][username] = dict()
+    _maketeams_job = MaketeamsJob(ctx)
+    profile_path = config['discord']['maketeams'].get('profile')
+    if profile_path:
+        _maketeams_job.profilers.append(cProfile.Profile())
+        _maketeams_job.profilers[0].enable()
+    try:
+        if args and args[0] == 'update':
+            await _update_teams(ctx, _maketeams_job)
+        else:
+            await _maketeams(ctx, _maketeams_job, new=bool(args) and args[0] == 'new', seed=seed, max_iterations=max_iterations)
+    finally:
+        if profile_path:
+            _maketeams_job.profilers[0].disable()
+            _dump_profile(profile_path, _maketeams_job.profilers)
+        _maketeams_job = None
 
-        # parse reactions => specialities
-        logging.info('maketeams: parsing reactions...')
-        for reaction in msg.reactions:
-            emoji_name = _emoji_to_name(reaction.emoji)
 
-            # if the emoji is meaningless, skip it
-            if not (speciality := config['discord']['specializations']['emojis'].get(emoji_name)):
-                continue
+'''
+merges the profiles of one !maketeams (the event loop's and the optimizer
+thread's) into one pstats file and logs the top of it
+'''
+def _dump_profile(path: str, profilers: list) -> None:
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(path)
 
-            async for user in reaction.users(limit=None, after=None):
-                user_dict = _get_db_user_from_user(user)
-                if 'specialities' not in user_dict:
-                    user_dict['specialities'] = list()
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(20)
+    logging.info('maketeams: wrote profile to %s, top functions:\n%s', path, out.getvalue())
 
-                user_dict['specialities'].append(speciality)
-                db.write()
 
-        await ctx.send('Generating optimized teams, please wait (this may take a few minutes)...', **msg_settings)
+'''
+runs the optimizer under its own profiler (cProfile only sees the thread it
+was started in). the chains of a parallel run are in other processes and
+don't show up
+'''
+def _profiled(run: typing.Callable, job: MaketeamsJob):
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # python 3.12+ profiles every thread with the one that's already running
+        return run()
 
-        teams = list()
-        _teams_locked = dict()
+    job.profilers.append(profiler)
+    try:
+        return run()
+    finally:
+        profiler.disable()
 
-        user_requests = list()
-        for username, details in db.db['users'].items():
-            if details.get('lock_team', False):
-                if username not in _teams_locked:
-                    team_locked = [
-                        {'username': x}
-                        for x in
-                        list({username} | set(details.get('team_requests', list())))
-                    ]
-                    teams.append(team_locked)
-                    for member in details.get('team_requests', list()):
-                        _teams_locked[member] = team_locked
 
-            else:
-                user_request = {
-                    'username': username,
-                    'noob': 'noob' in details.get('specialities', list()),
-                    'specialities': list(set(details.get('specialities', list())) - {'noob'}),
-                    'team_requests': details.get('team_requests', list())
-                }
-                user_requests.append(user_request)
-
-        logging.info('locked teams: %r' % teams)
-        logging.info('user_requests: %r' % user_requests)
-        start_time = time.time()
-        teams.extend(teamutil.get_optimized_teams(user_requests))
-        logging.info('generated teams: %r' % teams)
-
-        await ctx.send(f'Formed {len(teams)} teams of {teamutil.TEAM_SIZE} people in %.2f seconds.' % (time.time() - start_time), **msg_settings)
-
-        team_no = 1
+'''
+what teamutil needs to know about a user, from the db
+'''
+def _user_request(username: str) -> dict:
+    details = db.db['users'][username]
+    return {
+        'username': username,
+        'noob': 'noob' in details.get('specialities', list()),
+        'specialities': list(set(details.get('specialities', list())) - {'noob'}),
+        'team_requests': details.get('team_requests', list())
+    }
+
+
+'''
+builds the optimizer and runs it, meant for the executor: setting it up (the
+scoring engine, groups and the greedy start) alone takes seconds on a big
+event. the job gets the optimizer as soon as it exists, for status and cancel
+'''
+def _run_optimizer(job: MaketeamsJob, user_requests: list, seed: int, time_budget: float, max_iterations: int, **kwargs) -> list:
+    optimizer = teamutil.TeamOptimizer(user_requests, rng=random.Random(seed), **kwargs)
+    job.optimizer = optimizer
+    if job.cancelled:
+        # cancelled before there was an optimizer to stop
+        optimizer.stop()
+    return optimizer.run(time_budget=time_budget, max_iterations=max_iterations)
+
+
+'''
+reads specialities and requests from the db and runs the optimizer. returns
+the teams as lists of user dicts, or None if the job was cancelled. seed and
+max_iterations override maketeams.seed and maketeams.max-iterations
+'''
+async def _generate_teams(ctx: discord.ext.commands.context.Context, job: MaketeamsJob, seed: int=None, max_iterations: int=None) -> list:
+    job.stage = 'reading requests'
+
+    #  get_competitors() and make sure they all exist in the db
+    for user in await get_competitors(ctx):
+        username = str(user)
+        if username not in db.db['users']:
+            db.db['users'][username] = dict()
+            db.write(username)
+
+    # specialities are already in the db (see _set_speciality())
+
+    maketeams_config = config['discord']['maketeams']
+    time_budget = maketeams_config.get('time-budget')
+    if max_iterations is None:
+        max_iterations = maketeams_config.get('max-iterations')
+    if max_iterations:
+        # an iteration budget instead, so the seed reproduces the teams
+        time_budget = None
+
+    teams = list()
+    _teams_locked = set()
+
+    # by username: the optimizer's result depends on the order it gets the
+    # users in, and the db's order changes when it's compacted
+    user_requests = list()
+    for username in sorted(db.db['users']):
+        details = db.db['users'][username]
+        if details.get('lock_team', False):
+            if username not in _teams_locked:
+                team_locked = request_graph.group(username)
+                teams.append([{'username': x} for x in sorted(team_locked)])
+                _teams_locked |= team_locked
+
+        else:
+            user_requests.append(_user_request(username))
+
+    logging.info('locked teams: %s', logutil.summarize(teams))
+    logging.info('user_requests: %s', logutil.summarize(user_requests))
+    start_time = time.time()
+    chains = maketeams_config.get('chains', 1)
+    if seed is None:
+        seed = maketeams_config.get('seed')
+    # annealing needs a budget to cool down over
+    anneal = bool(time_budget or max_iterations) and maketeams_config.get('anneal', False)
+    contract = maketeams_config.get('contract-groups', True)
+    start = maketeams_config.get('start', 'greedy')
+    shard_size = maketeams_config.get('shard-size')
+    sharded = bool(shard_size) and len(user_requests) > shard_size
+    # the winning chain's seed reproduces its teams on its own, so with a
+    # seed configured only that one chain runs
+    parallel = not sharded and chains > 1 and seed is None
+    if sharded:
+        if seed is None:
+            seed = random.getrandbits(63)
+        job.stop_event = multiprocessing.get_context('spawn').Event()
+        run = functools.partial(teamutil.get_optimized_teams_sharded, user_requests, shard_size, seed=seed, time_budget=time_budget, max_iterations=max_iterations, anneal=anneal, stop_event=job.stop_event, contract=contract, start=start)
+    elif parallel:
+        job.stop_event = multiprocessing.get_context('spawn').Event()
+        run = functools.partial(teamutil.get_optimized_teams_parallel, user_requests, chains=chains, seed=seed, time_budget=time_budget, max_iterations=max_iterations, anneal=anneal, stop_event=job.stop_event, contract=contract, start=start)
+    else:
+        if seed is None:
+            seed = random.getrandbits(63)
+        run = functools.partial(_run_optimizer, job, user_requests, seed, time_budget, max_iterations, anneal=anneal, contract=contract, start=start)
+
+    if job.profilers:
+        run = functools.partial(_profiled, run, job)
+
+    # run the optimizer in a thread so the bot keeps answering the
+    # gateway and other commands, and keep one status message up to date
+    job.stage = 'optimizing'
+    job.time_budget = time_budget
+    status_message = await ctx.send(job.status(), **msg_settings)
+    future = asyncio.get_running_loop().run_in_executor(None, run)
+    while not future.done():
+        await asyncio.wait({future}, timeout=maketeams_config.get('progress-interval', 5))
+        try:
+            await status_message.edit(content=job.status())
+        except discord.HTTPException as e:
+            logging.warning('maketeams: unable to update status message: %s', e)
+
+    if sharded:
+        result = future.result()
+        logging.info('maketeams: shards: %s, refinement: %s', logutil.summarize(result['shards']), logutil.summarize(result['refinement']))
+        teams.extend(result['teams'])
+        contraction = None # every shard has its own
+    elif parallel:
+        result = future.result()
+        logging.info('maketeams: chains: %s', logutil.summarize(result['chains']))
+        teams.extend(result['teams'])
+        seed = result['seed']
+        contraction = result['contraction']
+    else:
+        teams.extend(future.result())
+        logging.info('maketeams: optimizer stopped (%s) after %d iterations', job.optimizer.stop_reason, job.optimizer.iterations)
+        contraction = job.optimizer.contraction
+
+    if contraction:
+        logging.info('maketeams: contraction: %r', contraction)
+
+    global _last_optimizer_stats
+    if sharded:
+        _last_optimizer_stats = result['refinement']['stats']
+    elif parallel:
+        _last_optimizer_stats = next(chain['stats'] for chain in result['chains'] if chain['seed'] == seed)
+    else:
+        _last_optimizer_stats = job.optimizer.stats()
+    bot_metrics.inc('maketeams_optimizer_runs_total', {'stop_reason': _last_optimizer_stats['stop_reason']}, help='team optimizations, by why they stopped')
+
+    if job.cancelled:
+        await ctx.send('Team generation cancelled, no channels were created.', **msg_settings)
+        return None
+
+    logging.info('generated teams: %s', logutil.summarize(teams))
+
+    # a seed only gives the same teams again with the same number of swaps,
+    # and a time budget's count depends on the machine. annealing on a time
+    # budget cools down by the clock, and each shard stops at its own count,
+    # so those can only be re-generated on an iteration budget
+    if not max_iterations and not anneal and not sharded:
+        max_iterations = _last_optimizer_stats['iterations']
+    msg = f'Formed {len(teams)} teams of {teamutil.TEAM_SIZE} people in %.2f seconds (seed: `%d`' % (time.time() - start_time, seed)
+    if max_iterations:
+        msg += ', %d swaps). Run `!maketeams new %d %d` to re-generate them from the same requests.' % (max_iterations, seed, max_iterations)
+    else:
+        msg += '). These teams can only be re-generated when they were made on an iteration budget (maketeams.max-iterations).'
+    await ctx.send(msg, **msg_settings)
+    if contraction and (contraction['groups'] or contraction['fixed_teams']):
+        await ctx.send('Kept %d groups of mutual requests together and %d complete teams as they were, so only %d units had to be placed instead of %d users.' % (contraction['groups'], contraction['fixed_teams'], contraction['units'], contraction['users']), **msg_settings)
+
+    return teams
+
+
+async def _maketeams(ctx: discord.ext.commands.context.Context, job: MaketeamsJob, new: bool, seed: int=None, max_iterations: int=None) -> None:
+    # make sure every request made so far is on disk before we start
+    db.flush()
+
+    stored = db.db.get('teams')
+    if stored and not new:
+        remaining = [team for team in stored if not team.get('pinned')]
+        if not remaining:
+            await ctx.send('Teams were already created. Use `!maketeams new` to generate a new set of teams.', **msg_settings)
+            return
+        await ctx.send('Resuming team channel creation: %d of %d teams still need to be set up (use `!maketeams new` to start over instead)...' % (len(remaining), len(stored)), **msg_settings)
+    else:
+        teams = await _generate_teams(ctx, job, seed, max_iterations)
+        if teams is None:
+            return
+
+        # everything the channels need, so a failed run can be resumed
+        db.db['teams'] = [
+            {
+                'name': 'team-%d' % team_no,
+                'members': [{'username': member['username'], 'specialities': member.get('specialities', list())} for member in team]
+            }
+            for team_no, team in enumerate(teams, 1)
+        ]
+        db.db.pop('teams_category_id', None)
+        db.write(keys=('teams', 'teams_category_id'))
+
+    await _provision_teams(ctx, job)
+
+
+'''
+fits competitors who got the role since the teams were made into them, and
+takes out the ones who lost it, with teamutil.repair_teams(). only the
+channels of teams that changed are touched: permission overwrites for the
+people joining and leaving, a welcome for the new ones, and channels for
+brand new teams. pending edits are stored on each team so a failed run can
+be finished with another `!maketeams update`
+'''
+async def _update_teams(ctx: discord.ext.commands.context.Context, job: MaketeamsJob) -> None:
+    db.flush()
+    stored = db.db.get('teams')
+    if not stored:
+        await ctx.send('There are no teams to update yet, run `!maketeams` first.', **msg_settings)
+        return
+
+    pending = [team for team in stored if 'joined' in team or 'left' in team]
+    if not pending and not all(team.get('pinned') for team in stored):
+        await ctx.send('Team channel creation didn\'t finish, run `!maketeams` to finish it before updating the teams.', **msg_settings)
+        return
+
+    if not pending:
+        job.stage = 'reading requests'
+        competitors = {str(user) for user in await get_competitors(ctx)}
+        for username in competitors:
+            if username not in db.db['users']:
+                db.db['users'][username] = dict()
+                db.write(username)
+
+        old_teams = [[member['username'] for member in team['members']] for team in stored]
+        on_teams = {username for team in old_teams for username in team}
+        added = sorted(competitors - on_teams)
+        removed = sorted(on_teams - competitors)
+        if not added and not removed:
+            await ctx.send('Every competitor is on a team already, nothing to update.', **msg_settings)
+            return
+
+        job.stage = 'repairing teams'
+        user_requests = [_user_request(username) for username in sorted(competitors)]
+        locked = [username for username in competitors if db.db['users'][username].get('lock_team', False)]
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, functools.partial(teamutil.repair_teams, old_teams, user_requests, added, removed, locked))
+        except ValueError as e:
+            await ctx.send('**Error:** Unable to update the teams: %s' % e, **msg_settings)
+            return
+        logging.info('maketeams update: added %s, removed %s, %d moves, changed teams %s', logutil.summarize(added), logutil.summarize(removed), result['moves'], logutil.summarize(result['changed']))
+
+        specialities = {user['username']: user['specialities'] for user in user_requests}
+        for team_no in result['changed']:
+            members = result['teams'][team_no]
+            if team_no >= len(stored):
+                stored.append({'name': 'team-%d' % (team_no + 1), 'members': list()})
+            team = stored[team_no]
+            before = {member['username'] for member in team['members']}
+            if 'channel_id' in team:
+                team['joined'] = sorted(set(members) - before)
+                team['left'] = sorted(before - set(members))
+            team['members'] = [{'username': username, 'specialities': specialities[username]} for username in members]
+        db.write(keys=('teams', 'teams_category_id'))
+
+        await ctx.send('Placed %d new competitors and took out %d who left, moving %d people. %d team channels need updating...' % (len(added), len(removed), result['moves'], len(result['changed'])), **msg_settings)
+        pending = [team for team in stored if 'joined' in team or 'left' in team]
+
+    job.stage = 'updating channels'
+    failed = list()
+    for team in pending:
+        if job.cancelled:
+            break
+
+        channel = ctx.guild.get_channel(team.get('channel_id') or 0)
+        if not channel:
+            # gone, let _provision_teams() make a new one with everyone in it
+            for key in ('joined', 'left', 'channel_id', 'message_id', 'pinned'):
+                team.pop(key, None)
+            db.write(keys=('teams', 'teams_category_id'))
+            continue
+
+        try:
+            for username in team['left']:
+                if member_obj := await resolve_user(ctx, username):
+                    await channel.set_permissions(member_obj, overwrite=None)
+
+            mentions = list()
+            for username in team['joined']:
+                if member_obj := await resolve_user(ctx, username):
+                    await channel.set_permissions(member_obj, overwrite=discord.PermissionOverwrite(read_messages=True))
+                    mentions.append(member_obj.mention if not TESTING_MODE else username)
+            if mentions:
+                await channel.send('Please welcome your new teammate(s): %s!' % ', '.join(mentions), **msg_settings)
+        except discord.HTTPException as e:
+            logging.error('maketeams update: unable to update %s: %s', team['name'], e)
+            failed.append(team['name'])
+            continue
+
+        team.pop('joined')
+        team.pop('left')
+        db.write(keys=('teams', 'teams_category_id'))
+
+    if failed:
+        await ctx.send('Unable to update `%s`. Run `!maketeams update` again to retry.' % ' '.join(failed), **msg_settings)
+
+    # new teams (and any whose channel went missing)
+    if not job.cancelled and not all(team.get('pinned') for team in stored):
+        await _provision_teams(ctx, job)
+    elif not failed:
+        await ctx.send('Updated the team channels.', **msg_settings)
+
+
+class _RateLimitCounter(logging.Filter):
+    '''
+    counts the 429s discord.py logs (and retries) on the discord.http logger.
+    only its "... responded with 429 ..." warning counts, the other lines
+    about the same 429 (global limit, bucket, done sleeping) would count it
+    again. needs discord.http at WARNING or below
+    '''
+    count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if 'responded with 429' in str(record.msg):
+            _RateLimitCounter.count += 1
+            bot_metrics.inc('discord_rate_limits_total', help='429s from discord (retried by discord.py)')
+        return True
+
+logging.getLogger('discord.http').addFilter(_RateLimitCounter())
+
+
+'''
+creates a channel for every team in db.db['teams'] that doesn't have one yet,
+then introduces the team and pins the introduction. channels are created in
+order (they share one rate limit bucket per guild) while the messages and
+pins, which are limited per channel, run concurrently. progress is stored on
+each team so a rerun picks up where this one stopped
+'''
+async def _provision_teams(ctx: discord.ext.commands.context.Context, job: MaketeamsJob) -> None:
+    job.stage = 'creating channels'
+    provisioning_config = config['discord']['maketeams'].get('provisioning', {})
+    message_slots = asyncio.Semaphore(provisioning_config.get('concurrency', 8))
+    start_time = time.time()
+    start_rate_limits = _RateLimitCounter.count
+    api_calls = 0
+
+    category = ctx.guild.get_channel(db.db.get('teams_category_id') or 0)
+    if not category:
         category = await ctx.guild.create_category('Teams')
-        for team in teams:
-            team_name = 'team-%d' % team_no
+        api_calls += 1
+        db.db['teams_category_id'] = category.id
+        db.write(keys=('teams', 'teams_category_id'))
+
+    organizers = discord.utils.get(ctx.guild.roles, name='Organizers')
+
+    async def introduce(team: dict, channel: discord.TextChannel) -> None:
+        nonlocal api_calls
+        async with message_slots:
+            if not team.get('message_id'):
+                teammates_msg = ''
+                for member in team['members']:
+                    member_obj = await resolve_user(ctx, member['username'])
+                    if not member_obj:
+                        # don't exit, just warn
+                        logging.warning('Unable to find member object for member %r!', member)
+                        continue
+                    
+                    teammates_msg += f'  *  ' + (member_obj.mention if not TESTING_MODE else member['username'])
+                    if member.get('specialities'):
+                        teammates_msg += ' (' + ', '.join(member['specialities']) + ')'
+                    teammates_msg += '\n'
+
+                message = await channel.send('''Hello! I created this channel for you and your new team. You may discuss your project or other group details here.
+
+Let me introduce you to your teammates:
+''' + teammates_msg + '''
+Start off by figuring out what you are all interested in, and figure out what project you want to make. Note that you don't have to use this channel to communicate if you prefer to communicate via other means.''', **msg_settings)
+                api_calls += 1
+                team['message_id'] = message.id
+                db.write(keys=('teams', 'teams_category_id'))
+
+            if job.cancelled:
+                return
+
+            await channel.get_partial_message(team['message_id']).pin()
+            api_calls += 1
+            team['pinned'] = True
+            db.write(keys=('teams', 'teams_category_id'))
+
+    introductions = list()
+    failed = list()
+    for team in db.db['teams']:
+        if job.cancelled:
+            break
+        if team.get('pinned'):
+            continue
+
+        channel = ctx.guild.get_channel(team.get('channel_id') or 0)
+        if not channel:
+            team_name = team['name']
             permissions = {
                 ctx.guild.default_role: discord.PermissionOverwrite(read_messages=False),
                 ctx.guild.me: discord.PermissionOverwrite(read_messages=True),
-                discord.utils.get(ctx.guild.roles, name='Organizers'): discord.PermissionOverwrite(read_messages=True)
+                organizers: discord.PermissionOverwrite(read_messages=True)
             }
 
-            for member in team:
-                permissions[await resolve_user(ctx, member['username'], use_cache=True)] = discord.PermissionOverwrite(read_messages=True)
+            for member in team['members']:
+                if member_obj := await resolve_user(ctx, member['username']):
+                    permissions[member_obj] = discord.PermissionOverwrite(read_messages=True)
 
-            channel = await ctx.guild.create_text_channel(team_name, category=category, topic=f'Discuss your HackOR project with your team ({team_name}) here.', overwrites=permissions)
+            try:
+                channel = await ctx.guild.create_text_channel(team_name, category=category, topic=f'Discuss your HackOR project with your team ({team_name}) here.', overwrites=permissions)
+            except discord.HTTPException as e:
+                logging.error('maketeams: unable to create channel for %s: %s', team['name'], e)
+                failed.append(team['name'])
+                continue
+            api_calls += 1
 
-            teammates_msg = ''
-            for member in team:
-                member_obj = await resolve_user(ctx, member['username'], use_cache=False)
-                if not member_obj:
-                    # don't exit, just warn
-                    logging.warning('Unable to find member object for member %r!' % member)
-                    continue
-                
-                teammates_msg += f'  *  ' + (member_obj.mention if not TESTING_MODE else member['username'])
-                if member.get('specialities'):
-                    teammates_msg += ' (' + ', '.join(member['specialities']) + ')'
-                teammates_msg += '\n'
+            # a new channel needs a new introduction
+            team['channel_id'] = channel.id
+            team.pop('message_id', None)
+            db.write(keys=('teams', 'teams_category_id'))
 
-            message = await channel.send('''Hello! I created this channel for you and your new team. You may discuss your project or other group details here.
+        introductions.append((team, asyncio.ensure_future(introduce(team, channel))))
+
+    for team, introduction in introductions:
+        try:
+            await introduction
+        except discord.HTTPException as e:
+            logging.error('maketeams: unable to introduce %s: %s', team['name'], e)
+            failed.append(team['name'])
+
+    elapsed = time.time() - start_time
+    done = sum(1 for team in db.db['teams'] if team.get('pinned'))
+    summary = 'Set up %d of %d team channels in %.2f seconds (%.1f API calls/s, %d rate limited).' % (done, len(db.db['teams']), elapsed, api_calls / max(elapsed, 0.001), _RateLimitCounter.count - start_rate_limits)
+    if job.cancelled:
+        summary = 'Team generation cancelled. ' + summary
+    if failed:
+        summary += ' Failed: `%s`. Run `!maketeams` again to retry.' % ' '.join(failed)
+    logging.info('maketeams: %s', summary)
+    await ctx.send(summary, **msg_settings)
 
-Let me introduce you to your teammates:
-''' + teammates_msg + '''
-Start off by figuring out what you are all interested in, and figure out what project you want to make. Note that you don't have to use this channel to communicate if you prefer to communicate via other means.''', **msg_settings)
-            await message.pin()
 
-            team_no += 1
+'''
+refreshes the gauges that are read from elsewhere (db, member index, ...)
+'''
+def _collect_metrics() -> None:
+    bot_metrics.set('bot_uptime_seconds', time.time() - _started)
+    for name, value in db.metrics.items():
+        bot_metrics.set('db_' + name, value, help='see db.metrics')
+    bot_metrics.set('member_index_size', len(member_index), help='members in the member index')
+    bot_metrics.set('member_index_lookups', member_index.hits, {'result': 'hit'}, help='member index lookups')
+    bot_metrics.set('member_index_lookups', member_index.misses, {'result': 'miss'})
+    for path, count in reaction_stats.items():
+        bot_metrics.set('bot_speciality_reactions', count, {'path': path}, help='speciality reactions, by whether they needed an api call')
+
+    optimizer_stats = _maketeams_job.optimizer.stats() if _maketeams_job and _maketeams_job.optimizer else _last_optimizer_stats
+    if optimizer_stats:
+        for name in ('iterations', 'accepted', 'rejected', 'best_score', 'elapsed', 'scoring_seconds', 'bookkeeping_seconds'):
+            bot_metrics.set('maketeams_optimizer_' + name, optimizer_stats[name], help='of the last (or running) !maketeams optimization')
+
+
+def _write_metrics() -> None:
+    path = config.get('stats', {}).get('prometheus-file')
+    if path:
+        _collect_metrics()
+        try:
+            bot_metrics.write(path)
+        except OSError as e:
+            logging.warning('unable to write metrics to %s: %s', path, e)
 
 
-    else:
-        await ctx.send('Wrong channel.', **msg_settings) # we use message send permission in channels for access control
+_metrics_writer = None
+
+async def _write_metrics_periodically() -> None:
+    while True:
+        await asyncio.sleep(config.get('stats', {}).get('interval', 15))
+        _write_metrics()
 
-    MAKETEAMS_LOCK = False
+
+def _format_seconds(seconds: float) -> str:
+    return '>%ds' % metrics.DEFAULT_BUCKETS[-1] if seconds == float('inf') else '%gs' % seconds
+
+
+@client.command(pass_context=True)
+async def stats(ctx: discord.ext.commands.context.Context, *args) -> None:
+    if ctx.channel.id != config['discord']['maketeams']['channel-id']:
+        await ctx.send('Wrong channel.', **msg_settings) # same access control as !maketeams
+        return
+
+    _collect_metrics()
+    _write_metrics()
+    lines = ['uptime: %dh%02dm' % divmod((time.time() - _started) // 60, 60)]
+
+    for labels, histogram in sorted(bot_metrics.get('bot_command_seconds').items()):
+        lines.append('!%s: %d runs, p50 <= %s, p99 <= %s, mean %.3fs' % (dict(labels)['command'], histogram.count, _format_seconds(histogram.quantile(0.5)), _format_seconds(histogram.quantile(0.99)), histogram.sum / histogram.count))
+
+    requests = sorted(bot_metrics.get('discord_api_requests_total').items(), key=lambda x: -x[1])
+    lines.append('discord api: %d requests, %d rate limited' % (sum(count for labels, count in requests), _RateLimitCounter.count))
+    for labels, count in requests[:5]:
+        lines.append('  %d %s %s' % (count, dict(labels)['method'], dict(labels)['route']))
+
+    lines.append('db: %d writes (%d coalesced), %d flushes (max %.3fs)' % (db.metrics['writes'], db.metrics['coalesced'], db.metrics['flushes'], db.metrics['flush_seconds_max']))
+    lookups = member_index.hits + member_index.misses
+    lines.append('member index: %d members, %.1f%% of %d lookups hit' % (len(member_index), 100 * member_index.hits / lookups if lookups else 100, lookups))
+    lines.append('speciality reactions: %d without api calls, %d with' % (reaction_stats['fast'], reaction_stats['slow']))
+
+    optimizer_stats = _maketeams_job.optimizer.stats() if _maketeams_job and _maketeams_job.optimizer else _last_optimizer_stats
+    if optimizer_stats:
+        lines.append('last maketeams: %s after %d swaps (%d kept, %d rejected) in %.1fs (%.1fs scoring, %.1fs bookkeeping), score %.1f' % (optimizer_stats['stop_reason'] or 'running', optimizer_stats['iterations'], optimizer_stats['accepted'], optimizer_stats['rejected'], optimizer_stats['elapsed'], optimizer_stats['scoring_seconds'], optimizer_stats['bookkeeping_seconds'], optimizer_stats['best_score']))
+
+    await ctx.send('```\n' + '\n'.join(lines)[:1900] + '\n```', **msg_settings)
 
 
 @client.command(pass_context=True)
@@ -420,7 +1174,16 @@ if __name__ == '__main__':
         config = yaml.safe_load(f.read())
         token = config.get('discord', {}).get('token')
         assert token, 'Config is missing discord.token'
+    logutil.setup(config.get('logging'))
+    _load_emoji_table()
 
+    db.SNAPSHOT_FORMAT = config.get('db', {}).get('snapshot-format', db.SNAPSHOT_FORMAT)
     db.read()
-
-    client.run(token)
+    request_graph = teamutil.RequestGraph.from_users(db.db['users'])
+
+    try:
+        # no handler of discord.py's own, its records go through ours
+        client.run(token, log_handler=None)
+    finally:
+        db.close()
+        logutil.shutdown()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import collections
+import time
+
+
+def normalize(name: str) -> str:
+    '''
+    normalizes whatever someone typed to refer to a member so lookups don't
+    care about case or a leading @
+    '''
+    return name.strip().lstrip('@').lower()
+
+
+class MemberIndex:
+    '''
+    in-memory index of guild members by id and by normalized name, so
+    resolving a username doesn't need a converter or an API call.
+
+    warm() it from guild.members once, then keep it current from the
+    on_member_join/on_member_update/on_member_remove/on_user_update events.
+    it holds at most max_size members (least recently used go first), and
+    entries older than ttl seconds are checked against the guild's own member
+    cache before they are handed out. once it has had to drop someone to stay
+    under max_size it's `trimmed`, and a miss no longer means there's no such
+    member.
+    '''
+
+    def __init__(self, max_size: int=100000, ttl: float=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.warmed = False
+        self.trimmed = False
+        self.hits = 0
+        self.misses = 0
+
+        self._members = collections.OrderedDict() # id => (member, time added), in LRU order
+        # normalized name => set of ids, one dict per tier in the order
+        # MemberConverter tries them: exact tag/id/mention, username, nickname
+        self._names = (dict(), dict(), dict())
+        self._keys = dict() # id => the (tier, name) pairs it is indexed under
+
+
+    def _names_of(self, member) -> set:
+        tag = {str(member), str(member.id), f'<@{member.id}>', f'<@!{member.id}>'}
+        nicks = {x for x in (getattr(member, 'nick', None), getattr(member, 'global_name', None)) if x}
+        return {(tier, normalize(x)) for tier, names in enumerate((tag, {member.name}, nicks)) for x in names}
+
+
+    def add(self, member) -> None:
+        self.remove(member)
+
+        keys = self._names_of(member)
+        for tier, key in keys:
+            self._names[tier].setdefault(key, set()).add(member.id)
+        self._keys[member.id] = keys
+        self._members[member.id] = (member, time.monotonic())
+
+        while len(self._members) > self.max_size:
+            evicted, x = self._members.popitem(last=False)
+            self._forget(evicted)
+            self.trimmed = True
+
+
+    def _forget(self, member_id: int) -> None:
+        for tier, key in self._keys.pop(member_id, ()):
+            ids = self._names[tier].get(key)
+            if ids:
+                ids.discard(member_id)
+                if not ids:
+                    del self._names[tier][key]
+
+
+    def remove(self, member) -> None:
+        self._members.pop(member.id, None)
+        self._forget(member.id)
+
+
+    def update(self, before, after) -> None:
+        # names or nickname may have changed, re-index from scratch
+        self.remove(before)
+        self.add(after)
+
+
+    def warm(self, members) -> None:
+        for member in members:
+            self.add(member)
+        self.warmed = True
+
+
+    def get_by_id(self, member_id: int):
+        entry = self._members.get(member_id)
+        if not entry:
+            return None
+
+        member, added = entry
+        if self.ttl is not None and time.monotonic() - added > self.ttl:
+            # re-check against discord.py's member cache (no API call)
+            fresh = member.guild.get_member(member_id) if getattr(member, 'guild', None) else member
+            if not fresh:
+                self.remove(member)
+                return None
+            self.add(fresh)
+            member = fresh
+
+        self._members.move_to_end(member_id)
+        return member
+
+
+    def get(self, name: str):
+        '''
+        looks up a member by name#discriminator, id, mention, username or
+        nickname, in that order. returns None if nothing matches, or if the
+        first kind of name that matches fits more than one member
+        '''
+        key = normalize(name)
+        ids = None
+        for names in self._names:
+            if ids := names.get(key):
+                break
+
+        if not ids or len(ids) > 1:
+            self.misses += 1
+            return None
+
+        member = self.get_by_id(next(iter(ids)))
+        if member:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return member
+
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+
+class RoleIndex:
+    '''
+    the members who have one role, by id. warm() it from guild.members once,
+    then keep it current from on_member_join/on_member_update/
+    on_member_remove (role changes come as member updates), so checking
+    whether someone has the role is a set lookup instead of a scan of their
+    roles, and listing everyone who has it doesn't walk the role's members
+    '''
+
+    def __init__(self, role_id: int=None):
+        self.role_id = role_id
+        self.warmed = False
+        self._members = dict() # id => member
+
+
+    def _has_role(self, member) -> bool:
+        return any(role.id == self.role_id for role in member.roles)
+
+
+    def add(self, member) -> None:
+        if self._has_role(member):
+            self._members[member.id] = member
+
+
+    def remove(self, member) -> None:
+        self._members.pop(member.id, None)
+
+
+    def update(self, before, after) -> None:
+        # only a role diff changes membership, but keep the newest member
+        # object either way so names stay current
+        if self._has_role(after):
+            self._members[after.id] = after
+        else:
+            self._members.pop(before.id, None)
+
+
+    def warm(self, members) -> None:
+        self._members.clear()
+        for member in members:
+            self.add(member)
+        self.warmed = True
+
+
+    def members(self) -> list:
+        return list(self._members.values())
+
+
+    def __contains__(self, member_id: int) -> bool:
+        return member_id in self._members
+
+
+    def __len__(self) -> int:
+        return len(self._members)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import bisect
+import math
+import os
+
+
+# seconds, from a quick command up to a long !maketeams
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    '''
+    counts observations into fixed buckets, like a prometheus histogram
+    '''
+
+    def __init__(self, buckets: tuple=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def quantile(self, q: float) -> float:
+        '''
+        upper bound of the bucket the q-th quantile falls in (inf if it's
+        past the last bucket, None if nothing was observed)
+        '''
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((labels or dict()).items()))
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in labels)
+    return '{' + ','.join('%s="%s"' % (name, value) for (name, x), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    '''
+    counters, gauges and histograms by name and labels. render() gives the
+    prometheus text format, write() puts it in a file for node_exporter's
+    textfile collector (or anything else that reads it)
+    '''
+
+    def __init__(self):
+        self._metrics = dict() # name => (type, help, {labels: value or Histogram})
+
+
+    def _get(self, kind: str, name: str, help: str) -> dict:
+        if name not in self._metrics:
+            self._metrics[name] = (kind, help, dict())
+        assert self._metrics[name][0] == kind, 'metric %r is a %s' % (name, self._metrics[name][0])
+        return self._metrics[name][2]
+
+
+    def inc(self, name: str, labels: dict=None, amount: float=1, help: str='') -> None:
+        values = self._get('counter', name, help)
+        key = _labels(labels)
+        values[key] = values.get(key, 0) + amount
+
+
+    def set(self, name: str, value: float, labels: dict=None, help: str='') -> None:
+        self._get('gauge', name, help)[_labels(labels)] = value
+
+
+    def observe(self, name: str, value: float, labels: dict=None, help: str='', buckets: tuple=DEFAULT_BUCKETS) -> None:
+        values = self._get('histogram', name, help)
+        key = _labels(labels)
+        if key not in values:
+            values[key] = Histogram(buckets)
+        values[key].observe(value)
+
+
+    def get(self, name: str) -> dict:
+        '''
+        {labels dict as a sorted tuple of pairs: value or Histogram} for name
+        '''
+        return dict(self._metrics[name][2]) if name in self._metrics else dict()
+
+
+    def render(self) -> str:
+        lines = list()
+        for name, (kind, help, values) in sorted(self._metrics.items()):
+            if help:
+                lines.append('# HELP %s %s' % (name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for labels, value in sorted(values.items()):
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(value.buckets + (math.inf,), value.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', _format_value(float(bound))),)), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(value.sum)))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), value.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path: str) -> None:
+        # write and rename so readers never see half a file
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
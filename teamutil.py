@@ -1,13 +1,50 @@
 #!/usr/bin/env python3
 
 import random
-import copy
 import math
+import os
+import array
+import collections
+import time
+import typing
+import threading
+import multiprocessing
+import concurrent.futures
+import argparse
+import json
+import csv
+import re
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    # only needed for get_optimized_teams(..., method='batch')
+    np = None
 
 
 SPECIALITIES = [ 'software', 'ui/ux', 'backend' ]
 TEAM_SIZE = 4
 
+
+def configure(team_size: int=None, specialities: list=None) -> None:
+    '''
+    changes TEAM_SIZE and/or SPECIALITIES for everything in this module,
+    including the worker processes it starts from then on
+    '''
+    global TEAM_SIZE, SPECIALITIES
+    if team_size is not None:
+        if team_size < 1:
+            raise ValueError('team size must be at least 1')
+        TEAM_SIZE = team_size
+    if specialities is not None:
+        SPECIALITIES = list(specialities)
+
+
+def _settings() -> dict:
+    # what configure() was called with, for worker processes
+    return {'team_size': TEAM_SIZE, 'specialities': SPECIALITIES}
+
 repr_team = lambda team: (sorted([x['username'] for x in team]))
 
 user_requests = [
@@ -104,73 +141,1702 @@ def score_team(team: list) -> float:
     return score
 
 
-def get_optimized_teams(user_requests: dict) -> list:
-    num_teams = math.ceil(len(user_requests) / TEAM_SIZE)
-    __teams_list = [list() for x in range(num_teams)] # need new list() instances, can't use [[]]*num_teams!
-    __user_requests = copy.deepcopy(user_requests) # we are going to make mods, so copy the dict
+class RequestGraph:
+    '''
+    who requested whom, indexed both ways. keeps forward and reverse request
+    edges, mutual partners, and connected components (of the undirected
+    request graph) in a union-find, so questions about one user's requests
+    cost O(their degree) instead of a scan over every user.
+    '''
+
+    def __init__(self):
+        self._requests = dict() # username => set of usernames they requested
+        self._requested_by = dict() # username => set of usernames requesting them
+        self._mutual = dict() # username => set of usernames they mutually requested
+
+        self._parent = dict() # union-find over request edges
+        self._stale = False # an edge was removed, components need a rebuild
+
+
+    @classmethod
+    def from_users(cls, users: dict) -> 'RequestGraph':
+        '''
+        builds the graph from a {username: {'team_requests': [...]}} dict,
+        like db.db['users']
+        '''
+        graph = cls()
+        for username, details in users.items():
+            graph.set_requests(username, details.get('team_requests', list()))
+        return graph
+
+
+    def set_requests(self, username: str, requested) -> None:
+        '''
+        replaces username's requests, updating only the edges that changed
+        '''
+        old = self._requests.get(username, set())
+        new = set(requested) - {username}
+        if not self._stale:
+            self._find(username) # a component of their own until they request someone
+
+        for other in old - new:
+            self._requested_by[other].discard(username)
+            if username in self._mutual.get(other, ()):
+                self._mutual[other].discard(username)
+                self._mutual[username].discard(other)
+            self._stale = True
+
+        for other in new - old:
+            self._requested_by.setdefault(other, set()).add(username)
+            if username in self._requests.get(other, ()):
+                self._mutual.setdefault(other, set()).add(username)
+                self._mutual.setdefault(username, set()).add(other)
+            if not self._stale:
+                self._union(username, other)
+
+        self._requests[username] = new
+
+
+    def requested(self, username: str) -> set:
+        return self._requests.get(username, set())
+
+
+    def requested_by(self, username: str) -> set:
+        return self._requested_by.get(username, set())
+
+
+    def mutual(self, username: str) -> set:
+        return self._mutual.get(username, set())
+
+
+    def is_mutual(self, username1: str, username2: str) -> bool:
+        return username2 in self._mutual.get(username1, ())
+
+
+    def group(self, username: str) -> set:
+        '''
+        username and everyone they requested
+        '''
+        return self.requested(username) | {username}
+
+
+    def group_problems(self, username: str) -> dict:
+        '''
+        for everyone in username's group who didn't request exactly the rest
+        of the group: {username: {'requested': [...], 'should_request': [...]}}.
+        empty when the group is fully mutual
+        '''
+        group = self.group(username)
+        problems = dict()
+        for member in group:
+            if self.requested(member) | {member} != group:
+                problems[member] = {
+                    'requested': list(self.requested(member)),
+                    'should_request': list(group - {member})
+                }
+        return problems
+
+
+    def is_fully_mutual(self, username: str) -> bool:
+        return not self.group_problems(username)
+
+
+    def _find(self, username: str) -> str:
+        parent = self._parent.setdefault(username, username)
+        while parent != self._parent[parent]:
+            # path halving
+            self._parent[parent] = self._parent[self._parent[parent]]
+            parent = self._parent[parent]
+        self._parent[username] = parent
+        return parent
+
+
+    def _union(self, username1: str, username2: str) -> None:
+        root1 = self._find(username1)
+        root2 = self._find(username2)
+        if root1 != root2:
+            self._parent[root1] = root2
+
+
+    def _rebuild(self) -> None:
+        # union-find can't remove edges, so start over after one was removed
+        self._parent = dict()
+        for username, requested in self._requests.items():
+            self._find(username)
+            for other in requested:
+                self._union(username, other)
+        self._stale = False
+
+
+    def component(self, username: str) -> str:
+        '''
+        an id for username's connected component (shared by everyone linked
+        to them through requests in either direction)
+        '''
+        if self._stale:
+            self._rebuild()
+        return self._find(username)
+
+
+    def components(self) -> list:
+        '''
+        every connected component as a set of usernames
+        '''
+        if self._stale:
+            self._rebuild()
+        components = dict()
+        for username in list(self._parent):
+            components.setdefault(self._find(username), set()).add(username)
+        return list(components.values())
+
+
+def contract_mutual_groups(user_requests: list, team_size: int=None) -> list:
+    '''
+    finds groups of up to team_size users who all requested each other and
+    have no other mutual requests, since they're going to end up on the same
+    team anyway. returns every user exactly once, as lists of indices into
+    user_requests: a list per group, and one-item lists for everyone else
+    '''
+    team_size = TEAM_SIZE if team_size is None else team_size
+    ids = {user['username']: i for i, user in enumerate(user_requests)}
+    requested = [{ids[x] for x in user['team_requests'] if x in ids} for user in user_requests]
+    mutual = [{j for j in requested[i] if j != i and i in requested[j]} for i in range(len(user_requests))]
+
+    units = list()
+    seen = set()
+    for i in range(len(user_requests)):
+        if i in seen:
+            continue
+
+        # everyone reachable through mutual requests
+        component = {i}
+        queue = [i]
+        while queue:
+            for j in mutual[queue.pop()]:
+                if j not in component:
+                    component.add(j)
+                    queue.append(j)
+        seen |= component
+
+        if len(component) <= team_size and all(mutual[j] == component - {j} for j in component):
+            units.append(sorted(component))
+        else:
+            # not a clique, or too big for one team: let the optimizer sort it out
+            units.extend([j] for j in sorted(component))
+
+    return units
+
+
+def team_key(members) -> tuple:
+    '''
+    the same key for the same people in any order
+    '''
+    return tuple(sorted(members))
+
+
+class ScoreCache:
+    '''
+    least recently used cache of team scores by team_key(), holding at most
+    max_size entries. hits and misses count get() calls
+    '''
+
+    def __init__(self, max_size: int=65536):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+
+    def put(self, key: tuple, value) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None, 'size': len(self._entries), 'max_size': self.max_size}
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ScoringEngine:
+    '''
+    scores teams the same way score_team() does, but from precomputed tables
+    keyed by integer user ids instead of re-scanning username lists. the
+    friend weights are added in one go rather than pair by pair in member
+    order, so the two can differ by float rounding (well under 1e-9), never
+    more.
+
+    load() an assignment of ids into teams, then propose() a swap to get the
+    new scores of both teams as a delta against the cached per-team
+    aggregates, and commit() it if it's any good.
+
+    users are kept as a struct of arrays indexed by id (a byte per flag, an
+    index into a table of the distinct speciality count vectors, and requests
+    as flat int arrays with per-user offsets), so a big event costs a few
+    bytes per user rather than a few python objects. `users` only holds on to the dicts to hand them back.
+
+    with a ScoreCache, propose() looks the new teams up by team_key() before
+    scoring them, so swaps that keep getting undone and retried are only
+    scored once.
+    '''
+
+    def __init__(self, user_requests: list, specialities: list=None, cache: ScoreCache=None):
+        self.users = list(user_requests)
+        self.cache = cache
+        self.specialities = list(SPECIALITIES if specialities is None else specialities)
+        self.ids = {user['username']: i for i, user in enumerate(self.users)}
+
+        speciality_ids = {speciality: i for i, speciality in enumerate(self.specialities)}
+        num_users = len(self.users)
+
+        # per-user flags, and which speciality count vector each user has
+        # (there are only a few distinct ones). counts rather than bits, a
+        # speciality listed twice counts twice like it does in score_team()
+        self.noob = bytearray(num_users)
+        self.nospec = bytearray(num_users)
+        self.self_request = bytearray(num_users)
+        self.spec_profile = array.array('I', bytes(4 * num_users))
+        self._spec_vectors = list()
+        profiles = dict() # vector => its index in _spec_vectors
+
+        # requests to people who aren't competing can never be satisfied, so
+        # they are dropped here. user i requested the ids in
+        # requested_ids[requested_offsets[i]:requested_offsets[i + 1]]
+        requested_offsets = array.array('q', [0])
+        requested_ids = array.array('q')
+        for i, user in enumerate(self.users):
+            self.noob[i] = bool(user['noob'])
+            self.nospec[i] = not user['specialities']
+            vector = [0] * len(self.specialities)
+            for speciality in user['specialities']:
+                vector[speciality_ids[speciality]] += 1
+            vector = tuple(vector)
+            if vector not in profiles:
+                profiles[vector] = len(self._spec_vectors)
+                self._spec_vectors.append(vector)
+            self.spec_profile[i] = profiles[vector]
+
+            requested = sorted({self.ids[x] for x in user['team_requests'] if x in self.ids})
+            self.self_request[i] = i in requested
+            requested_ids.extend(requested)
+            requested_offsets.append(len(requested_ids))
+
+        # pairwise affinity table: who wants to be with whom, split by whether
+        # the feeling is mutual or only one-way. stored the same way as the
+        # requests, see partners()
+        mutual = (array.array('q'), array.array('q'))
+        oneway = (array.array('q'), array.array('q'))
+        for i in range(num_users):
+            for j in requested_ids[requested_offsets[i]:requested_offsets[i + 1]]:
+                if i == j:
+                    continue
+                if i in requested_ids[requested_offsets[j]:requested_offsets[j + 1]]:
+                    mutual[0].append(i)
+                    mutual[1].append(j)
+                else:
+                    oneway[0].extend((i, j))
+                    oneway[1].extend((j, i))
+        self.mutual_offsets, self.mutual_ids = self._group_by_user(num_users, *mutual)
+        self.oneway_offsets, self.oneway_ids = self._group_by_user(num_users, *oneway)
+
+        self._weights = dict()
+
+        self.team_of = [None] * len(self.users)
+        self.members = list()
+        self.aggregates = list()
+        self.scores = list()
+
+
+    @staticmethod
+    def _group_by_user(num_users: int, sources: array.array, targets: array.array) -> tuple:
+        # (offsets, ids) so that the targets of user i are
+        # ids[offsets[i]:offsets[i + 1]], with a counting sort
+        offsets = array.array('q', bytes(8 * (num_users + 1)))
+        for i in sources:
+            offsets[i + 1] += 1
+        for i in range(num_users):
+            offsets[i + 1] += offsets[i]
+
+        ids = array.array('q', bytes(8 * len(targets)))
+        position = array.array('q', offsets[:-1])
+        for i, j in zip(sources, targets):
+            ids[position[i]] = j
+            position[i] += 1
+        return offsets, ids
+
+
+    def mutual(self, i: int) -> array.array:
+        '''
+        ids user i and each other requested
+        '''
+        return self.mutual_ids[self.mutual_offsets[i]:self.mutual_offsets[i + 1]]
+
+
+    def oneway(self, i: int) -> array.array:
+        '''
+        ids user i requested or was requested by, but not both
+        '''
+        return self.oneway_ids[self.oneway_offsets[i]:self.oneway_offsets[i + 1]]
+
+
+    def spec_vector(self, i: int) -> tuple:
+        '''
+        how many of each speciality user i has
+        '''
+        return self._spec_vectors[self.spec_profile[i]]
+
+
+    def _specialities_weight(self, team_size: int, nospecs: int) -> float:
+        # built up by repeated multiplication like score_team() does so the
+        # floats come out bit-for-bit the same
+        weights = self._weights.get(team_size)
+        if weights is None:
+            weights = self._weights[team_size] = [1]
+        while len(weights) <= nospecs:
+            weights.append(weights[-1] * (1 - (1 / team_size)))
+        return weights[nospecs]
+
+
+    def aggregate(self, members: list) -> tuple:
+        '''
+        computes the aggregate tuple of a team from scratch: (size, noobs,
+        users without specialities, self requests, mutual pairs, one-way
+        pairs, speciality counts)
+        '''
+        members_set = set(members)
+        spec = [0] * len(self.specialities)
+        noobs = nospecs = selfreqs = mutual = oneway = 0
+        for i in members:
+            noobs += self.noob[i]
+            nospecs += self.nospec[i]
+            selfreqs += self.self_request[i]
+            mutual += sum(j in members_set for j in self.mutual(i))
+            oneway += sum(j in members_set for j in self.oneway(i))
+            for k, count in enumerate(self._spec_vectors[self.spec_profile[i]]):
+                spec[k] += count
+
+        # every pair was counted from both ends
+        return (len(members), noobs, nospecs, selfreqs, mutual // 2, oneway // 2, tuple(spec))
+
+
+    def score(self, aggregate: tuple) -> float:
+        size, noobs, nospecs, selfreqs, mutual, oneway, spec = aggregate
+        score = float(abs(noobs - (size - noobs)) * size)
+        score -= (max(spec) - min(spec)) / len(self.specialities) * size * self._specialities_weight(size, nospecs)
+        score += (2 * mutual + selfreqs) * (size ** 2) + oneway * size
+        return score
+
+
+    def score_members(self, members: list) -> float:
+        return self.score(self.aggregate(members))
+
+
+    def load(self, teams: list) -> list:
+        '''
+        sets the current assignment (a list of lists of user ids) and returns
+        the score of each team
+        '''
+        self.members = [list(members) for members in teams]
+        for team_no, members in enumerate(self.members):
+            for i in members:
+                self.team_of[i] = team_no
+
+        self.aggregates = [self.aggregate(members) for members in self.members]
+        self.scores = [self.score(aggregate) for aggregate in self.aggregates]
+        return list(self.scores)
+
+
+    def _moved(self, team_no: int, removed: set, added: set) -> tuple:
+        size, noobs, nospecs, selfreqs, mutual, oneway, spec = self.aggregates[team_no]
+        spec = list(spec)
+        team_of = self.team_of
+        mutual_offsets, mutual_ids = self.mutual_offsets, self.mutual_ids
+        oneway_offsets, oneway_ids = self.oneway_offsets, self.oneway_ids
+
+        # pairs touching a leaving user. pairs among the leavers are seen from
+        # both ends, so they count half
+        lost_mutual = lost_oneway = inner_mutual = inner_oneway = 0
+        for i in removed:
+            for j in mutual_ids[mutual_offsets[i]:mutual_offsets[i + 1]]:
+                if j in removed:
+                    inner_mutual += 1
+                elif team_of[j] == team_no:
+                    lost_mutual += 1
+            for j in oneway_ids[oneway_offsets[i]:oneway_offsets[i + 1]]:
+                if j in removed:
+                    inner_oneway += 1
+                elif team_of[j] == team_no:
+                    lost_oneway += 1
+
+            noobs -= self.noob[i]
+            nospecs -= self.nospec[i]
+            selfreqs -= self.self_request[i]
+            for k, count in enumerate(self._spec_vectors[self.spec_profile[i]]):
+                spec[k] -= count
+        mutual -= lost_mutual + inner_mutual // 2
+        oneway -= lost_oneway + inner_oneway // 2
+
+        # same again for the pairs touching a joining user, with the people
+        # staying and the other joiners
+        gained_mutual = gained_oneway = inner_mutual = inner_oneway = 0
+        for i in added:
+            for j in mutual_ids[mutual_offsets[i]:mutual_offsets[i + 1]]:
+                if j in added:
+                    inner_mutual += 1
+                elif team_of[j] == team_no and j not in removed:
+                    gained_mutual += 1
+            for j in oneway_ids[oneway_offsets[i]:oneway_offsets[i + 1]]:
+                if j in added:
+                    inner_oneway += 1
+                elif team_of[j] == team_no and j not in removed:
+                    gained_oneway += 1
+
+            noobs += self.noob[i]
+            nospecs += self.nospec[i]
+            selfreqs += self.self_request[i]
+            for k, count in enumerate(self._spec_vectors[self.spec_profile[i]]):
+                spec[k] += count
+        mutual += gained_mutual + inner_mutual // 2
+        oneway += gained_oneway + inner_oneway // 2
+
+        size += len(added) - len(removed)
+        return (size, noobs, nospecs, selfreqs, mutual, oneway, tuple(spec))
+
+
+    def propose(self, team1_no: int, team2_no: int, out1: set, out2: set) -> tuple:
+        '''
+        scores moving the users in out1 from team1 to team2 and the users in
+        out2 from team2 to team1 without changing anything. returns the new
+        (score1, score2, aggregate1, aggregate2)
+        '''
+        if self.cache is not None:
+            score1, aggregate1 = self._cached(team1_no, out1, out2)
+            score2, aggregate2 = self._cached(team2_no, out2, out1)
+            return score1, score2, aggregate1, aggregate2
+
+        aggregate1 = self._moved(team1_no, out1, out2)
+        aggregate2 = self._moved(team2_no, out2, out1)
+        return self.score(aggregate1), self.score(aggregate2), aggregate1, aggregate2
+
+
+    def _cached(self, team_no: int, removed: set, added: set) -> tuple:
+        # (score, aggregate) of the team after the move, from the cache if
+        # this exact team was scored before
+        key = team_key([i for i in self.members[team_no] if i not in removed] + list(added))
+        entry = self.cache.get(key)
+        if entry is None:
+            aggregate = self._moved(team_no, removed, added)
+            entry = (self.score(aggregate), aggregate)
+            self.cache.put(key, entry)
+        return entry
+
+
+    def commit(self, team1_no: int, team2_no: int, members1: list, members2: list, proposal: tuple) -> None:
+        score1, score2, aggregate1, aggregate2 = proposal
+        for i in members1:
+            self.team_of[i] = team1_no
+        for i in members2:
+            self.team_of[i] = team2_no
+
+        self.members[team1_no] = members1
+        self.members[team2_no] = members2
+        self.aggregates[team1_no] = aggregate1
+        self.aggregates[team2_no] = aggregate2
+        self.scores[team1_no] = score1
+        self.scores[team2_no] = score2
+
+
+class TeamOptimizer:
+    '''
+    anytime team optimizer. run() keeps improving the assignment until it is
+    out of time or iterations, or until stop() is called from another thread,
+    and best_teams() returns the best assignment seen so far.
+
+    method picks the search: 'hillclimb' tries one random swap at a time,
+    'batch' scores thousands of swaps at once with numpy, which goes a lot
+    further on large events. with anneal=True the hill climb also accepts
+    some swaps that make things worse (less and less often as the budget runs
+    out) to get out of local optima.
+
+    with contract=True, groups of users who all requested each other (see
+    contract_mutual_groups()) are only ever moved as a whole. groups that
+    fill a team are set aside as finished teams, and `contraction` says how
+    much smaller that made the problem. the batch method leaves groups on the
+    team they start on and moves everyone else around them.
+
+    start picks the starting assignment: 'greedy' puts groups of mutual
+    requests together and deals everyone else out to keep noobs together and
+    specialities even, 'random' deals everyone out at random (but keeps the
+    groups together with contract=True). initial_teams (lists of indices into
+    user_requests) starts from a given assignment instead, and setting
+    team_pairs to a list of (team1, team2) pairs makes the hill climb only
+    swap between those.
+
+    score_cache, if set, keeps the scores of up to that many team
+    compositions the hill climb has seen (see ScoreCache). the batch method
+    scores with numpy and doesn't use it.
+
+    stats() says how the runs went. observer, if given, is called with
+    stats() whenever the score trajectory gets a new point and once more
+    when run() returns, from whatever thread run() is in.
+    '''
+
+    # how often the clock and the stop flag are checked, in iterations
+    CHECK_EVERY = 256
+
+    # minimum seconds between points of the score trajectory
+    TRAJECTORY_INTERVAL = 0.1
+
+    def __init__(self, user_requests: list, method: str='hillclimb', rng: random.Random=None, anneal: bool=False, temperature: float=None, stop_event: threading.Event=None, contract: bool=False, observer: typing.Callable=None, start: str='greedy', initial_teams: list=None, score_cache: int=None):
+        if method not in ('hillclimb', 'batch'):
+            raise ValueError('unknown optimizer method: %r' % method)
+        if anneal and method != 'hillclimb':
+            raise ValueError('annealing is only supported by the hillclimb method')
+        if initial_teams is not None and contract:
+            raise ValueError('contract=True builds its own starting teams, it can\'t take initial_teams')
+
+        self.method = method
+        self.rng = random if rng is None else rng
+        self.anneal = anneal
+        self.temperature = float(TEAM_SIZE if temperature is None else temperature)
+        self.user_requests = user_requests
+        if start not in ('greedy', 'random'):
+            raise ValueError('unknown start: %r' % start)
+
+        # full teams of mutual requests are done already, everyone else goes
+        # to the engine. _ids maps engine ids back to user_requests indices
+        self._fixed_members = list()
+        self._ids = list(range(len(user_requests)))
+        self.contraction = None
+        units = None
+        if contract:
+            units = contract_mutual_groups(user_requests)
+            self._fixed_members = [unit for unit in units if len(unit) == TEAM_SIZE]
+            units = [unit for unit in units if len(unit) < TEAM_SIZE]
+            self._ids = [i for unit in units for i in unit]
+            if all(len(unit) == 1 for unit in units):
+                # nobody to keep together, so start exactly like contract=False
+                self.contraction = {'users': len(user_requests), 'units': len(units), 'groups': 0, 'fixed_teams': len(self._fixed_members), 'split_groups': 0}
+                units = None
+        self.engine = ScoringEngine([user_requests[i] for i in self._ids], cache=ScoreCache(score_cache) if score_cache else None)
+
+        self.iterations = 0
+        self.stop_reason = None
+        self.observer = observer
+
+        # instrumentation, see stats()
+        self.accepted = 0 # swaps kept
+        self.rejected = 0 # swaps scored and thrown away
+        self.scoring_seconds = 0.0
+        self.run_seconds = 0.0 # of the runs that finished
+        self.trajectory = list() # (seconds into the runs, best score)
+        self._running = False
+        # anything with is_set()/set() works, e.g. a multiprocessing.Event
+        self._stop = threading.Event() if stop_event is None else stop_event
+        self._start_time = None
+        self._start_iterations = 0
+        self._deadline = None
+        self._max_iterations = None
+
+        num_users = len(self._ids)
+        num_teams = math.ceil(num_users / TEAM_SIZE)
+
+        self._unit_of = None # engine id => the ids it has to move with
+        if initial_teams is not None:
+            # without contract, engine ids are user_requests indices
+            self.engine.load(initial_teams)
+        else:
+            # engine ids of everyone who should start out together. groups are
+            # only worth looking for when something is going to use them
+            if units is None and start == 'greedy':
+                units = contract_mutual_groups(self.engine.users)
+            elif units is None:
+                units = [[i] for i in range(num_users)]
+            else:
+                engine_ids = {user_id: i for i, user_id in enumerate(self._ids)}
+                units = [[engine_ids[user_id] for user_id in unit] for unit in units]
+
+            self.engine.load(self._initial_teams(units, num_teams, greedy=(start == 'greedy'), keep_units=self.contraction is None and contract))
+
+        # (team1, team2) pairs the hill climb picks from, None for any two teams
+        self.team_pairs = None
+
+        # for printing people on teams + score
+        #[print(repr_team([self.engine.users[i] for i in team]), score) for team, score in zip(self.engine.members, self.engine.scores)]
+
+        self._fixed_score = sum(score_team([user_requests[i] for i in team]) for team in self._fixed_members)
+        self.score = self.best_score = sum(self.engine.scores) + self._fixed_score
+        self._best_members = None # None while the current assignment is the best one
+
+
+    def _initial_teams(self, units: list, num_teams: int, greedy: bool, keep_units: bool) -> list:
+        '''
+        the starting assignment, in linear time: groups of engine ids in
+        `units` go on a team together first, then everyone else is dealt out,
+        either at random or greedily (see _fill_greedy()). with keep_units the
+        groups are also remembered so the hill climb only moves them whole
+        '''
+        # team sizes come out the same as dealing users out one at a time
+        num_users = len(self.engine.users)
+        room = [num_users // num_teams + (team_no < num_users % num_teams) for team_no in range(num_teams)]
+        teams = [list() for x in range(num_teams)] # need new list() instances, can't use [[]]*num_teams!
+
+        # teams by how much room they have left, in random order
+        by_room = [list() for x in range(TEAM_SIZE + 1)]
+        order = list(range(num_teams))
+        self.rng.shuffle(order)
+        for team_no in order:
+            by_room[room[team_no]].append(team_no)
+
+        # biggest groups first, each on the team it fills up best so the
+        # bigger ones still fit
+        multi = [unit for unit in units if len(unit) > 1]
+        self.rng.shuffle(multi)
+        multi.sort(key=len, reverse=True)
+
+        unit_of = [None] * num_users
+        singles = [unit[0] for unit in units if len(unit) == 1]
+        groups = split = 0
+        for unit in multi:
+            fit = next((r for r in range(len(unit), len(by_room)) if by_room[r]), None)
+            if fit is None:
+                # no team has room left for the whole group, place them one by one
+                singles.extend(unit)
+                split += 1
+                continue
+
+            team_no = by_room[fit].pop()
+            teams[team_no].extend(unit)
+            room[team_no] -= len(unit)
+            by_room[room[team_no]].append(team_no)
+            groups += 1
+            for i in unit:
+                unit_of[i] = tuple(unit)
+
+        self.rng.shuffle(singles)
+        if greedy:
+            self._fill_greedy(teams, room, singles)
+        else:
+            slots = [team_no for team_no in range(num_teams) for x in range(room[team_no])]
+            for team_no, i in zip(slots, singles):
+                teams[team_no].append(i)
+
+        if keep_units:
+            for i in singles:
+                unit_of[i] = (i,)
+            self.contraction = {
+                'users': len(self.user_requests),
+                'units': groups + len(singles),
+                'groups': groups,
+                'fixed_teams': len(self._fixed_members),
+                'split_groups': split
+            }
+            if groups:
+                self._unit_of = unit_of
+            # otherwise there's nothing to keep together, use the plain swaps
+
+        return teams
+
+
+    def _fill_greedy(self, teams: list, room: list, singles: list) -> None:
+        '''
+        fills the rest of the teams one seat per team per round. every seat
+        goes to whoever keeps the team's noobs together and its specialities
+        most even, like score_team() likes it. singles should be shuffled,
+        ties go to whoever comes first
+        '''
+        engine = self.engine
+
+        # users by (noob, speciality vector), there are only a few kinds
+        pools = dict()
+        for i in singles:
+            pools.setdefault((bool(engine.noob[i]), engine.spec_vector(i)), list()).append(i)
+        remaining = {True: 0, False: 0}
+        for (noob, vector), pool in pools.items():
+            remaining[noob] += len(pool)
 
-    if len(user_requests) <= TEAM_SIZE:
-        return [user_requests]
+        noobs = [sum(engine.noob[i] for i in team) for team in teams]
+        spec = [[sum(counts) for counts in zip(*[engine.spec_vector(i) for i in team])] or [0] * len(engine.specialities) for team in teams]
 
-    # make teams
-    i = 0
-    while __user_requests:
-        user = random.choice(__user_requests)
-        __teams_list[i % num_teams].append(user)
-        __user_requests.remove(user)
-        i += 1
+        open_teams = [team_no for team_no in range(len(teams)) if room[team_no]]
+        while open_teams and pools:
+            still_open = list()
+            for team_no in open_teams:
+                if not pools:
+                    break
 
-    _teams = [ (team, score_team(team)) for team in __teams_list ]
+                size = len(teams[team_no])
+                # noobs go with noobs. an empty team takes from whichever kind
+                # has more people left
+                want_noob = noobs[team_no] * 2 > size if size else remaining[True] > remaining[False]
 
-    # for printing people on teams + score
-    #[print(repr_team(team), score) for team, score in _teams]
+                best_key = best_cost = None
+                for key in pools:
+                    noob, vector = key
+                    counts = [a + b for a, b in zip(spec[team_no], vector)]
+                    cost = (noob != want_noob, max(counts) - min(counts), not any(vector))
+                    if best_cost is None or cost < best_cost:
+                        best_key, best_cost = key, cost
 
-    operations_since_last_change = 0
-    while operations_since_last_change < len(_teams) * 20000: # TODO/XXX: hardcoded constant! :(
-        # swap a couple random people
-        team1_no = random.randint(0, num_teams - 1)
-        
-        while (team2_no := random.randint(0, num_teams - 1)) == team1_no:
-            pass
+                pool = pools[best_key]
+                i = pool.pop()
+                if not pool:
+                    del pools[best_key]
 
-        team1, last_team1_score = _teams[team1_no]
-        team2, last_team2_score = _teams[team2_no]
+                teams[team_no].append(i)
+                remaining[best_key[0]] -= 1
+                noobs[team_no] += best_key[0]
+                spec[team_no] = [a + b for a, b in zip(spec[team_no], best_key[1])]
+                room[team_no] -= 1
+                if room[team_no]:
+                    still_open.append(team_no)
+            open_teams = still_open
 
-        potential_team1 = team1.copy()
-        potential_team2 = team2.copy()
 
-        for i in range(random.randint(0, TEAM_SIZE-1)):
-            person1_no = random.randint(0, len(potential_team1) - 1)
-            person2_no = random.randint(0, len(potential_team2) - 1)
+    def stop(self) -> None:
+        '''
+        makes run() return the best assignment so far. safe to call from any
+        thread
+        '''
+        self._stop.set()
 
-            person1 = potential_team1[person1_no]
-            person2 = potential_team2[person2_no]
 
-            potential_team1[person1_no] = person2
-            potential_team2[person2_no] = person1
+    def progress(self) -> dict:
+        '''
+        how the current run() is going: 'iterations' so far, 'elapsed'
+        seconds, 'iterations_per_second', 'best_score' and 'eta' (seconds
+        left, or None when it runs until it stalls). safe to call from another
+        thread
+        '''
+        now = time.monotonic()
+        elapsed = now - self._start_time if self._start_time is not None else 0.0
+        rate = (self.iterations - self._start_iterations) / elapsed if elapsed > 0 else 0.0
 
-            # for debugging duplicate people on teams
-            #assert not (len(set(repr_team(potential_team1))) < len(repr_team(potential_team1))), 'found the bug in team1 when swapping people with team1 ' + str(repr_team(team1)) + ' to potential_team1 ' + str(repr_team(potential_team1)) + ' (person1: %d, person2: %d)' % (person1_no, person2_no) + ' where team2 is ' + str(repr_team(team2))
-            #assert not (len(set(repr_team(potential_team2))) < len(repr_team(potential_team2))), 'found the bug in team2 when swapping people with ' + str(repr_team(team2)) + ' to ' + str(repr_team(potential_team2)) + ' (person1: %d, person2: %d)' % (person1_no, person2_no)
+        eta = None
+        if self._deadline is not None:
+            eta = max(self._deadline - now, 0.0)
+        if self._max_iterations is not None and rate:
+            eta = min(eta if eta is not None else math.inf, max(self._max_iterations - self.iterations, 0) / rate)
 
-        potential_team1_score = score_team(potential_team1)
-        potential_team2_score = score_team(potential_team2)
+        return {
+            'iterations': self.iterations,
+            'elapsed': elapsed,
+            'iterations_per_second': rate,
+            'best_score': self.best_score,
+            'eta': eta
+        }
 
-        if (potential_team1_score > last_team1_score and potential_team2_score > last_team2_score) or (potential_team1_score > last_team1_score and potential_team2_score == last_team2_score) or (potential_team1_score == last_team1_score and potential_team2_score > last_team2_score):
-            # for debugging what scores we impoved on
-            # print('Swap', potential_team1_score, last_team1_score, '--', potential_team2_score, last_team2_score)
 
-            # teams are better, so keep these
-            _teams[team1_no] = (potential_team1, potential_team1_score)
-            _teams[team2_no] = (potential_team2, potential_team2_score)
+    def _elapsed(self) -> float:
+        # seconds spent in run(), over every call
+        if self._running:
+            return self.run_seconds + time.monotonic() - self._start_time
+        return self.run_seconds
 
+
+    def stats(self) -> dict:
+        '''
+        'iterations', 'accepted' and 'rejected' swaps, 'best_score',
+        'stop_reason', 'elapsed' seconds split into 'scoring_seconds' and
+        'bookkeeping_seconds' (everything else), and the best score over time
+        as (seconds, score) pairs under 'trajectory', and the ScoreCache
+        stats under 'cache' (None without one). counts add up over every call
+        to run(). safe to call from another thread
+        '''
+        elapsed = self._elapsed()
+        return {
+            'iterations': self.iterations,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'best_score': self.best_score,
+            'stop_reason': self.stop_reason,
+            'elapsed': elapsed,
+            'scoring_seconds': self.scoring_seconds,
+            'bookkeeping_seconds': max(elapsed - self.scoring_seconds, 0.0),
+            'trajectory': list(self.trajectory),
+            'cache': None if self.engine.cache is None else self.engine.cache.stats()
+        }
+
+
+    def _checkpoint(self, final: bool=False) -> None:
+        # adds a trajectory point if the score moved (and the last point
+        # isn't too recent), then tells the observer
+        elapsed = self._elapsed()
+        moved = self.trajectory[-1][1] != self.best_score
+        if moved and (final or elapsed - self.trajectory[-1][0] >= self.TRAJECTORY_INTERVAL):
+            self.trajectory.append((elapsed, self.best_score))
+        elif not final:
+            return
+
+        if self.observer:
+            self.observer(self.stats())
+
+
+    def best_members(self) -> list:
+        '''
+        best assignment so far as lists of indices into user_requests
+        '''
+        members = self._best_members if self._best_members is not None else self.engine.members
+        return [list(team) for team in self._fixed_members] + [ [self._ids[i] for i in team] for team in members ]
+
+
+    def best_teams(self) -> list:
+        return [ [self.user_requests[i] for i in team] for team in self.best_members() ]
+
+
+    def run(self, time_budget: float=None, deadline: float=None, max_iterations: int=None, stall_iterations: int=None) -> list:
+        '''
+        optimizes until time_budget seconds have passed, the time.monotonic()
+        deadline is reached, max_iterations more swaps were tried, or stop()
+        is called, then returns best_teams().
+
+        stall_iterations stops early once that many swaps in a row didn't
+        change anything. if no budget is given at all it defaults to
+        num_teams * 20000 (batch_size * 50 for 'batch').
+        '''
+        self._start_time = time.monotonic()
+        self._start_iterations = self.iterations
+        self._deadline = deadline
+        if time_budget is not None:
+            self._deadline = min(self._start_time + time_budget, deadline or math.inf)
+        self._max_iterations = None if max_iterations is None else self.iterations + max_iterations
+        unbounded = self._deadline is None and self._max_iterations is None
+
+        if self.anneal and unbounded:
+            raise ValueError('annealing needs a time budget or an iteration limit to cool down over')
+
+        if not self.trajectory:
+            self.trajectory.append((0.0, self.best_score))
+
+        self._running = True
+        try:
+            if len(self.engine.members) < 2:
+                self.stop_reason = 'stalled' # nothing to swap
+            elif self.method == 'batch':
+                self._run_batch(stall_iterations if stall_iterations or not unbounded else self.BATCH_SIZE * 50)
+            else:
+                self._run_hillclimb(stall_iterations if stall_iterations or not unbounded else len(self.engine.members) * 20000)
+        finally:
+            self.run_seconds += time.monotonic() - self._start_time
+            self._running = False
+
+        self._checkpoint(final=True)
+        return self.best_teams()
+
+
+    def _out_of_budget(self) -> bool:
+        if self._stop.is_set():
+            self.stop_reason = 'stopped'
+        elif self._deadline is not None and time.monotonic() >= self._deadline:
+            self.stop_reason = 'deadline'
+        elif self._max_iterations is not None and self.iterations >= self._max_iterations:
+            self.stop_reason = 'iterations'
+        else:
+            return False
+        return True
+
+
+    def _budget_used(self) -> float:
+        # fraction of the budget used up so far, for the cooling schedule
+        used = 0.0
+        if self._deadline is not None:
+            used = (time.monotonic() - self._start_time) / max(self._deadline - self._start_time, 1e-9)
+        if self._max_iterations is not None:
+            used = max(used, 1 - (self._max_iterations - self.iterations) / max(self._max_iterations, 1))
+        return min(used, 1.0)
+
+
+    def _accept(self, score: float) -> None:
+        # keep track of the best assignment. only copy it when we're about to
+        # leave it for a worse one
+        if score < self.score and self._best_members is None:
+            self._best_members = [list(team) for team in self.engine.members]
+
+        self.score = score
+        if score > self.best_score:
+            self.best_score = score
+            self._best_members = None
+
+
+    def _run_hillclimb(self, stall_iterations: int) -> None:
+        engine = self.engine
+        rng = self.rng
+        num_teams = len(engine.members)
+        temperature = self.temperature
+        unit_of = self._unit_of
+        team_pairs = self.team_pairs
+
+        operations_since_last_change = 0
+        while True:
+            if stall_iterations and operations_since_last_change >= stall_iterations:
+                self.stop_reason = 'stalled'
+                break
+            if self._max_iterations is not None and self.iterations >= self._max_iterations:
+                self.stop_reason = 'iterations'
+                break
+            if self.iterations % self.CHECK_EVERY == 0:
+                if self._out_of_budget():
+                    break
+                self._checkpoint()
+                if self.anneal:
+                    # cool down geometrically to 1/1000th of the start temperature
+                    temperature = self.temperature * 0.001 ** self._budget_used()
+
+            self.iterations += 1
+            operations_since_last_change += 1
+
+            # swap a couple random people
+            if team_pairs:
+                team1_no, team2_no = team_pairs[rng.randint(0, len(team_pairs) - 1)]
+            else:
+                team1_no = rng.randint(0, num_teams - 1)
+            
+                while (team2_no := rng.randint(0, num_teams - 1)) == team1_no:
+                    pass
+
+            team1 = engine.members[team1_no]
+            team2 = engine.members[team2_no]
+            last_team1_score = engine.scores[team1_no]
+            last_team2_score = engine.scores[team2_no]
+
+            potential_team1 = team1.copy()
+            potential_team2 = team2.copy()
+
+            for i in range(rng.randint(0, TEAM_SIZE-1)):
+                if unit_of is not None:
+                    self._swap_units(potential_team1, potential_team2)
+                    continue
+
+                person1_no = rng.randint(0, len(potential_team1) - 1)
+                person2_no = rng.randint(0, len(potential_team2) - 1)
+
+                person1 = potential_team1[person1_no]
+                person2 = potential_team2[person2_no]
+
+                potential_team1[person1_no] = person2
+                potential_team2[person2_no] = person1
+
+            # people can get swapped straight back, so only score who actually moved
+            out1 = set(team1) - set(potential_team1)
+            out2 = set(team2) - set(potential_team2)
+            if not out1:
+                continue
+
+            scoring_started = time.perf_counter()
+            proposal = engine.propose(team1_no, team2_no, out1, out2)
+            self.scoring_seconds += time.perf_counter() - scoring_started
+            potential_team1_score, potential_team2_score = proposal[:2]
+
+            if (potential_team1_score > last_team1_score and potential_team2_score > last_team2_score) or (potential_team1_score > last_team1_score and potential_team2_score == last_team2_score) or (potential_team1_score == last_team1_score and potential_team2_score > last_team2_score):
+                # for debugging what scores we impoved on
+                # print('Swap', potential_team1_score, last_team1_score, '--', potential_team2_score, last_team2_score)
+
+                # teams are better, so keep these
+                pass
+            elif self.anneal:
+                # metropolis rule on the change in total score
+                delta = (potential_team1_score - last_team1_score) + (potential_team2_score - last_team2_score)
+                if delta < 0 and rng.random() >= math.exp(delta / temperature):
+                    self.rejected += 1
+                    continue
+            else:
+                self.rejected += 1
+                continue
+
+            self.accepted += 1
+            self._accept(self.score + (potential_team1_score - last_team1_score) + (potential_team2_score - last_team2_score))
+            engine.commit(team1_no, team2_no, potential_team1, potential_team2, proposal)
+            operations_since_last_change = 0
+
+        # re-add the scores exactly, the running total picks up float noise
+        if self._best_members is None:
+            self.score = self.best_score = sum(engine.scores) + self._fixed_score
+
+
+    def _swap_units(self, team1: list, team2: list) -> None:
+        # swaps a random unit on team1 for units of the same total size on
+        # team2, if it can find some
+        unit_of = self._unit_of
+        unit1 = unit_of[self.rng.choice(team1)]
+
+        out2 = list()
+        for x in range(TEAM_SIZE):
+            unit2 = unit_of[self.rng.choice(team2)]
+            if unit2 in out2 or sum(map(len, out2)) + len(unit2) > len(unit1):
+                continue
+            out2.append(unit2)
+            if sum(map(len, out2)) == len(unit1):
+                break
+        else:
+            return
+
+        out2 = {i for unit in out2 for i in unit}
+        team1[:] = [i for i in team1 if i not in unit1] + list(out2)
+        team2[:] = [i for i in team2 if i not in out2] + list(unit1)
+
+
+    BATCH_SIZE = 4096
+
+    def _run_batch(self, stall_iterations: int) -> None:
+        '''
+        vectorized hill climb: scores BATCH_SIZE random swaps per step with
+        numpy and applies the best ones that don't touch the same teams. uses
+        the same "neither team gets worse" rule as the hill climb.
+        '''
+        if np is None:
+            raise RuntimeError('the batch optimizer needs numpy installed')
+
+        engine = self.engine
+        batch_size = self.BATCH_SIZE
+        np_rng = np.random.default_rng(self.rng.getrandbits(64))
+        num_users = len(engine.users)
+        num_teams = len(engine.members)
+        num_specialities = len(engine.specialities)
+
+        # per-user vectors
+        user_noob = np.frombuffer(engine.noob, dtype=np.uint8).astype(np.int64)
+        user_nospec = np.frombuffer(engine.nospec, dtype=np.uint8).astype(np.int64)
+        user_selfreq = np.frombuffer(engine.self_request, dtype=np.uint8).astype(np.int64)
+        user_spec = np.array(engine._spec_vectors, dtype=np.int64).reshape(-1, num_specialities)[np.frombuffer(engine.spec_profile, dtype=np.uintc)]
+        # users in a group of mutual requests stay where they are
+        pinned = np.array([self._unit_of is not None and len(self._unit_of[i]) > 1 for i in range(num_users)] + [False], dtype=bool)
+
+        # sparse affinity table as sorted (i * num_users + j) keys, both directions.
+        # kind is 1 for mutual pairs and 2 for one-way pairs
+        keys = list()
+        kinds = list()
+        for kind, offsets, ids in ((1, engine.mutual_offsets, engine.mutual_ids), (2, engine.oneway_offsets, engine.oneway_ids)):
+            sources = np.repeat(np.arange(num_users, dtype=np.int64), np.diff(np.frombuffer(offsets, dtype=np.int64)))
+            keys.append(sources * num_users + np.frombuffer(ids, dtype=np.int64))
+            kinds.append(np.full(len(ids), kind, dtype=np.int64))
+        keys = np.concatenate(keys)
+        kinds = np.concatenate(kinds)
+        order = np.argsort(keys)
+        pair_keys = np.append(keys[order], -1) # sentinel so searchsorted never runs off the end
+        pair_kinds = np.append(kinds[order], 0)
+
+        def links(x, y):
+            # (mutual, one-way) flags for every pair x[...] -> y[...]. -1 is padding
+            found = np.searchsorted(pair_keys[:-1], x * num_users + y)
+            kind = np.where((pair_keys[found] == x * num_users + y) & (x >= 0) & (y >= 0), pair_kinds[found], 0)
+            return kind == 1, kind == 2
+
+        # current assignment as arrays, padded with -1 where a team is short
+        max_size = max(len(members) for members in engine.members)
+        members = np.full((num_teams, max_size), -1, dtype=np.int64)
+        for team_no, team in enumerate(engine.members):
+            members[team_no, :len(team)] = team
+
+        sizes = np.array([aggregate[0] for aggregate in engine.aggregates], dtype=np.int64)
+        noobs = np.array([aggregate[1] for aggregate in engine.aggregates], dtype=np.int64)
+        nospecs = np.array([aggregate[2] for aggregate in engine.aggregates], dtype=np.int64)
+        selfreqs = np.array([aggregate[3] for aggregate in engine.aggregates], dtype=np.int64)
+        mutual = np.array([aggregate[4] for aggregate in engine.aggregates], dtype=np.int64)
+        oneway = np.array([aggregate[5] for aggregate in engine.aggregates], dtype=np.int64)
+        spec = np.array([aggregate[6] for aggregate in engine.aggregates], dtype=np.int64).reshape(num_teams, num_specialities)
+        scores = np.array(engine.scores, dtype=np.float64)
+
+        # specialities weight by (team size, users without specialities), taken
+        # from the engine so the floats match its scores
+        weights = np.zeros((max_size + 1, max_size + 1), dtype=np.float64)
+        for size in set(sizes.tolist()):
+            for nospec in range(size + 1):
+                weights[size, nospec] = engine._specialities_weight(size, nospec)
+
+        def moved(team, removed, added):
+            # new aggregates of `team` once the users in `removed` leave and the
+            # users in `added` join. removed/added are (batch, k) arrays
+            team_members = members[team]
+            staying = team_members >= 0
+            for k in range(removed.shape[1]):
+                staying &= team_members != removed[:, k:k + 1]
+
+            lost = links(removed[:, :, None], team_members[:, None, :])
+            inner_removed = links(removed[:, :, None], removed[:, None, :])
+            gained = links(added[:, :, None], np.where(staying, team_members, -1)[:, None, :])
+            inner_added = links(added[:, :, None], added[:, None, :])
+
+            new_mutual = mutual[team] - lost[0].sum((1, 2)) + inner_removed[0].sum((1, 2)) // 2 + gained[0].sum((1, 2)) + inner_added[0].sum((1, 2)) // 2
+            new_oneway = oneway[team] - lost[1].sum((1, 2)) + inner_removed[1].sum((1, 2)) // 2 + gained[1].sum((1, 2)) + inner_added[1].sum((1, 2)) // 2
+            new_noobs = noobs[team] - user_noob[removed].sum(1) + user_noob[added].sum(1)
+            new_nospecs = nospecs[team] - user_nospec[removed].sum(1) + user_nospec[added].sum(1)
+            new_selfreqs = selfreqs[team] - user_selfreq[removed].sum(1) + user_selfreq[added].sum(1)
+            new_spec = spec[team] - user_spec[removed].sum(1) + user_spec[added].sum(1)
+            size = sizes[team]
+
+            # same operations in the same order as ScoringEngine.score()
+            score = (np.abs(new_noobs - (size - new_noobs)) * size).astype(np.float64)
+            score -= (new_spec.max(1) - new_spec.min(1)) / num_specialities * size * weights[size, new_nospecs]
+            score += ((2 * new_mutual + new_selfreqs) * (size ** 2) + new_oneway * size).astype(np.float64)
+            return score, (new_noobs, new_nospecs, new_selfreqs, new_mutual, new_oneway, new_spec)
+
+        # swapping everyone on a team is the same as swapping no one
+        max_moved = max(1, TEAM_SIZE // 2)
+        step = 0
+        operations_since_last_change = 0
+        while True:
+            if stall_iterations and operations_since_last_change >= stall_iterations:
+                self.stop_reason = 'stalled'
+                break
+            if self._out_of_budget():
+                break
+            self._checkpoint()
+
+            k = 1 + step % max_moved
+            step += 1
+            self.iterations += batch_size
+            operations_since_last_change += batch_size
+
+            # pick random team pairs and k random slots on each team
+            team1 = np_rng.integers(0, num_teams, batch_size)
+            team2 = np_rng.integers(0, num_teams, batch_size)
+            slots1 = np.argsort(np_rng.random((batch_size, max_size)), axis=1)[:, :k]
+            slots2 = np.argsort(np_rng.random((batch_size, max_size)), axis=1)[:, :k]
+            out1 = np.take_along_axis(members[team1], slots1, 1)
+            out2 = np.take_along_axis(members[team2], slots2, 1)
+            valid = (team1 != team2) & (out1 >= 0).all(1) & (out2 >= 0).all(1) & ~pinned[out1].any(1) & ~pinned[out2].any(1)
+            if not valid.any():
+                continue
+            team1, team2, out1, out2 = team1[valid], team2[valid], out1[valid], out2[valid]
+
+            scoring_started = time.perf_counter()
+            score1, aggregates1 = moved(team1, out1, out2)
+            score2, aggregates2 = moved(team2, out2, out1)
+            self.scoring_seconds += time.perf_counter() - scoring_started
+            last1 = scores[team1]
+            last2 = scores[team2]
+            better = (score1 >= last1) & (score2 >= last2) & ((score1 > last1) | (score2 > last2))
+            if not better.any():
+                self.rejected += len(team1)
+                continue
+
+            # apply the best improvements first, skipping any that touch a team
+            # that already changed this step
+            candidates = np.flatnonzero(better)
+            candidates = candidates[np.argsort(-((score1 - last1) + (score2 - last2))[candidates], kind='stable')]
+            used = np.zeros(num_teams, dtype=bool)
+            chosen = list()
+            for c in candidates.tolist():
+                if used[team1[c]] or used[team2[c]]:
+                    continue
+                used[team1[c]] = used[team2[c]] = True
+                chosen.append(c)
+
+            chosen = np.array(chosen, dtype=np.int64)
+            self.accepted += len(chosen)
+            self.rejected += len(team1) - len(chosen)
+            for team, score, aggregates, slots, added in ((team1, score1, aggregates1, slots1[valid], out2), (team2, score2, aggregates2, slots2[valid], out1)):
+                t = team[chosen]
+                scores[t] = score[chosen]
+                new_noobs, new_nospecs, new_selfreqs, new_mutual, new_oneway, new_spec = aggregates
+                noobs[t] = new_noobs[chosen]
+                nospecs[t] = new_nospecs[chosen]
+                selfreqs[t] = new_selfreqs[chosen]
+                mutual[t] = new_mutual[chosen]
+                oneway[t] = new_oneway[chosen]
+                spec[t] = new_spec[chosen]
+                members[t[:, None], slots[chosen]] = added[chosen]
+
+            # the exact total is re-added once at the end
+            self.score = self.best_score = float(scores.sum()) + self._fixed_score
             operations_since_last_change = 0
 
-        operations_since_last_change += 1
+        # hand the result back to the engine. every accepted step was an
+        # improvement, so this is also the best assignment
+        engine.load([row[row >= 0].tolist() for row in members])
+        self.score = self.best_score = sum(engine.scores) + self._fixed_score
+
+
+def get_optimized_teams(user_requests: dict, method: str='hillclimb', seed: int=None, time_budget: float=None, max_iterations: int=None, anneal: bool=False, contract: bool=False, observer: typing.Callable=None, start: str='greedy', shard_size: int=None, score_cache: int=None) -> list:
+    '''
+    splits user_requests into teams of TEAM_SIZE, see TeamOptimizer for the
+    options (and what observer gets called with). with a seed the result is
+    reproducible, otherwise the global random module is used.
+
+    with shard_size, events bigger than that are optimized in shards by
+    get_optimized_teams_sharded() instead (and observer isn't called)
+    '''
+    if shard_size and len(user_requests) > shard_size:
+        return get_optimized_teams_sharded(user_requests, shard_size, method, seed=seed, time_budget=time_budget, max_iterations=max_iterations, anneal=anneal, contract=contract, start=start, score_cache=score_cache)['teams']
+
+    optimizer = TeamOptimizer(user_requests, method, rng=(random if seed is None else random.Random(seed)), anneal=anneal, contract=contract, observer=observer, start=start, score_cache=score_cache)
+    return optimizer.run(time_budget=time_budget, max_iterations=max_iterations)
 
-    return [ x[0] for x in _teams ]
+
+# set in each worker process by _init_chain_worker() so the user list is only
+# sent once per process rather than once per chain
+_chain_user_requests = None
+
+
+_chain_stop_event = None
+
+
+def _init_chain_worker(user_requests: list, stop_event, settings: dict=None) -> None:
+    global _chain_user_requests, _chain_stop_event
+    _chain_user_requests = user_requests
+    _chain_stop_event = stop_event
+    if settings:
+        configure(**settings)
+
+
+def _run_chain(seed: int, options: dict) -> tuple:
+    optimizer = TeamOptimizer(_chain_user_requests, options['method'], rng=random.Random(seed), anneal=options['anneal'], stop_event=_chain_stop_event, contract=options['contract'], start=options['start'], score_cache=options['score_cache'])
+    optimizer.run(time_budget=options['time_budget'], max_iterations=options['max_iterations'])
+    return optimizer.best_members(), optimizer.best_score, optimizer.contraction, optimizer.stats()
+
+
+def get_optimized_teams_parallel(user_requests: list, chains: int=None, method: str='hillclimb', seed: int=None, workers: int=None, time_budget: float=None, max_iterations: int=None, anneal: bool=False, stop_event=None, contract: bool=False, start: str='greedy', score_cache: int=None) -> dict:
+    '''
+    runs `chains` independent optimizations in a process pool and keeps the
+    one with the highest total score. every chain gets its own seed (derived
+    from `seed`), so the winner can be re-generated exactly with
+    get_optimized_teams(user_requests, method, seed=result['seed'], ...)
+    given the same options (and an iteration rather than time budget).
+
+    setting stop_event (from multiprocessing.get_context('spawn').Event())
+    makes every chain return its best assignment so far.
+
+    returns a dict with the winning 'teams', its total 'score', 'seed' and
+    'contraction' (see TeamOptimizer), and the 'seed', 'score' and 'stats'
+    (see TeamOptimizer.stats()) of every chain under 'chains'.
+    '''
+    chains = chains or os.cpu_count() or 1
+    seed_rng = random.Random(seed)
+    seeds = [seed_rng.getrandbits(63) for x in range(chains)]
+    options = {'method': method, 'time_budget': time_budget, 'max_iterations': max_iterations, 'anneal': anneal, 'contract': contract, 'start': start, 'score_cache': score_cache}
+
+    # spawn rather than fork, the bot calls this with an event loop running
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers or chains, chains), mp_context=multiprocessing.get_context('spawn'), initializer=_init_chain_worker, initargs=(user_requests, stop_event, _settings())) as executor:
+        results = list(executor.map(_run_chain, seeds, [options] * chains))
+
+    best = max(range(chains), key=lambda i: results[i][1]) # ties go to the earliest chain
+    members, score, contraction = results[best][:3]
+    return {
+        'teams': [ [user_requests[i] for i in team] for team in members ],
+        'score': score,
+        'seed': seeds[best],
+        'contraction': contraction,
+        'chains': [ {'seed': chain_seed, 'score': result[1], 'stats': result[3]} for chain_seed, result in zip(seeds, results) ]
+    }
+
+
+def get_optimized_teams_sharded(user_requests: list, shard_size: int=2000, method: str='hillclimb', seed: int=None, workers: int=None, time_budget: float=None, max_iterations: int=None, anneal: bool=False, stop_event=None, contract: bool=False, start: str='greedy', compare: bool=False, score_cache: int=None, on_team: typing.Callable=None) -> dict:
+    '''
+    divide and conquer for big events: splits the users into shards of about
+    shard_size (see shard_users()), optimizes every shard on its own in a
+    process pool of `workers` (in this process with workers=1), then runs a
+    hill climb that only swaps between teams that have someone requesting
+    someone in another shard. the shards get 80% of time_budget, the
+    boundary pass the rest.
+
+    with compare=True the flat optimizer also gets a go at the whole thing
+    with the same seed and the same time_budget, to see what sharding cost
+    or gained.
+
+    on_team, if given, is called with every team (a list of user dicts) as
+    soon as it's final: teams without anyone requesting across shards when
+    their shard is done, the rest after the boundary pass.
+
+    returns a dict with the 'teams', their total 'score', the 'seed', the
+    'seconds' it took, the 'users', 'score' and 'stats' of each of the
+    'shards', what the 'refinement' pass did, and the 'flat' optimizer's
+    'score' and 'seconds' (None unless compare is set).
+    '''
+    start_time = time.monotonic()
+    seed_rng = random.Random(seed)
+    shards = shard_users(user_requests, shard_size, seed_rng)
+    seeds = [seed_rng.getrandbits(63) for x in shards]
+
+    workers = min(workers or os.cpu_count() or 1, len(shards))
+    rounds = math.ceil(len(shards) / workers)
+    options = {
+        'method': method,
+        'time_budget': None if time_budget is None else time_budget * 0.8 / rounds,
+        'max_iterations': max_iterations,
+        'anneal': anneal,
+        'contract': contract,
+        'start': start,
+        'score_cache': score_cache
+    }
+
+    # the boundary: people with a request going from one shard to another
+    ids = {user['username']: i for i, user in enumerate(user_requests)}
+    shard_of = [None] * len(user_requests)
+    for shard_no, shard in enumerate(shards):
+        for i in shard:
+            shard_of[i] = shard_no
+    links = [(i, ids[x]) for i, user in enumerate(user_requests) for x in user['team_requests'] if x in ids and shard_of[ids[x]] != shard_of[i]]
+    boundary = bytearray(len(user_requests))
+    for i, j in links:
+        boundary[i] = boundary[j] = 1
+
+    # back to indices into user_requests. only teams with someone on the
+    # boundary can change after their shard is done
+    teams = list()
+    def finished(shard: list, result: tuple) -> tuple:
+        for team in result[0]:
+            team = [shard[i] for i in team]
+            teams.append(team)
+            if on_team and not any(boundary[i] for i in team):
+                on_team([user_requests[i] for i in team])
+        return result
+
+    shard_users_list = [[user_requests[i] for i in shard] for shard in shards]
+    if workers == 1:
+        _init_chain_worker(None, stop_event)
+        results = [finished(shard, result) for shard, result in zip(shards, map(_run_shard, shard_users_list, seeds, [options] * len(shards)))]
+    else:
+        # spawn rather than fork, the bot calls this with an event loop running
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_chain_worker, initargs=(None, stop_event, _settings())) as executor:
+            results = [finished(shard, result) for shard, result in zip(shards, executor.map(_run_shard, shard_users_list, seeds, [options] * len(shards)))]
+
+    team_of = [None] * len(user_requests)
+    for team_no, team in enumerate(teams):
+        for i in team:
+            team_of[i] = team_no
+    team_pairs = {(min(team_of[i], team_of[j]), max(team_of[i], team_of[j])) for i, j in links}
+
+    refiner = TeamOptimizer(user_requests, 'hillclimb', rng=random.Random(seeds[0] if seeds else seed), stop_event=stop_event, initial_teams=teams, score_cache=score_cache)
+    refinement = {'team_pairs': len(team_pairs), 'score_before': refiner.best_score}
+    if team_pairs:
+        refiner.team_pairs = sorted(team_pairs)
+        remaining = None if time_budget is None else max(time_budget - (time.monotonic() - start_time), 0.0)
+        refiner.run(time_budget=remaining, max_iterations=max_iterations, stall_iterations=len(team_pairs) * 2000 if remaining is None and max_iterations is None else None)
+    refinement.update({'score_after': refiner.best_score, 'stats': refiner.stats()})
+
+    # the boundary pass keeps team numbers, and only touched these
+    if on_team:
+        for team_no, team in enumerate(refiner.best_teams()):
+            if any(boundary[i] for i in teams[team_no]):
+                on_team(team)
+
+    result = {
+        'teams': refiner.best_teams(),
+        'score': refiner.best_score,
+        'seed': seed,
+        'seconds': time.monotonic() - start_time,
+        'shards': [ {'users': len(shard), 'score': shard_result[1], 'stats': shard_result[2]} for shard, shard_result in zip(shards, results) ],
+        'refinement': refinement,
+        'flat': None
+    }
+
+    if compare:
+        flat_start = time.monotonic()
+        flat = TeamOptimizer(user_requests, method, rng=random.Random(seed), anneal=anneal, stop_event=stop_event, contract=contract, start=start, score_cache=score_cache)
+        flat.run(time_budget=time_budget, max_iterations=max_iterations)
+        result['flat'] = {'score': flat.best_score, 'seconds': time.monotonic() - flat_start}
+
+    return result
+
+
+def shard_users(user_requests: list, shard_size: int, rng: random.Random=None) -> list:
+    '''
+    splits user_requests into shards (lists of indices) of about shard_size
+    people, rounded to whole teams. people linked by requests (in either
+    direction) stay in the same shard unless their connected component is
+    bigger than a shard, in which case it's cut in breadth-first order so
+    the people on either side of a cut are still mostly near each other
+    '''
+    rng = random if rng is None else rng
+    names = {user['username'] for user in user_requests}
+    graph = RequestGraph()
+    for user in user_requests:
+        graph.set_requests(user['username'], [x for x in user['team_requests'] if x in names])
+
+    ids = {user['username']: i for i, user in enumerate(user_requests)}
+    components = [sorted(ids[x] for x in component) for component in graph.components()]
+    components.sort() # components() comes out in hash order
+    rng.shuffle(components)
+
+    num_shards = max(1, round(len(user_requests) / max(shard_size, 1)))
+    size = max(math.ceil(len(user_requests) / num_shards / TEAM_SIZE) * TEAM_SIZE, TEAM_SIZE)
+
+    # components too big for a shard fill whole shards of their own, cut
+    # breadth-first so cuts fall between neighbours. what's left over of
+    # them gets packed like any other component
+    shards = list()
+    pieces = list()
+    for component in components:
+        if len(component) <= size:
+            pieces.append(component)
+            continue
+
+        seen = {component[0]}
+        queue = [component[0]]
+        for i in queue:
+            username = user_requests[i]['username']
+            for other in sorted(graph.requested(username) | graph.requested_by(username)):
+                j = ids[other]
+                if j not in seen:
+                    seen.add(j)
+                    queue.append(j)
+        whole = len(queue) - len(queue) % size
+        shards.extend(queue[i:i + size] for i in range(0, whole, size))
+        if whole < len(queue):
+            pieces.append(queue[whole:])
+
+    # first fit decreasing: the big pieces go first, the small ones fill up
+    # the gaps, so shards come out full and nothing else is split
+    pieces.sort(key=len, reverse=True) # stable, equal sizes stay shuffled
+    open_shards = list()
+    for piece in pieces:
+        for shard in open_shards:
+            if len(shard) + len(piece) <= size:
+                break
+        else:
+            shard = list()
+            shards.append(shard)
+            open_shards.append(shard)
+        shard.extend(piece)
+        if len(shard) == size:
+            open_shards.remove(shard)
+
+    return shards
+
+
+def _run_shard(shard_user_requests: list, seed: int, options: dict) -> tuple:
+    optimizer = TeamOptimizer(shard_user_requests, options['method'], rng=random.Random(seed), anneal=options['anneal'], stop_event=_chain_stop_event, contract=options['contract'], start=options['start'], score_cache=options['score_cache'])
+    optimizer.run(time_budget=options['time_budget'], max_iterations=options['max_iterations'])
+    return optimizer.best_members(), optimizer.best_score, optimizer.stats()
+
+def repair_teams(teams: list, user_requests: list, added: list=(), removed: list=(), locked: list=(), max_moves: int=None) -> dict:
+    '''
+    fixes up an existing assignment after people signed up late (`added`)
+    or dropped out (`removed`), moving as few people as possible. teams are
+    lists of usernames as they are now, user_requests has everyone who'll be
+    on a team afterwards, and teams with someone in `locked` are left alone
+    (apart from losing dropouts).
+
+    teams left with too few people for the new head count are broken up,
+    then newcomers and anyone from a broken up team go wherever they add the
+    most score, short teams are filled up from full ones, and finally a hill
+    climb swaps people between the teams that changed and everyone else.
+    everyone who ends up on a different team than before counts as a move,
+    and the hill climb stops adding moves once there are max_moves (default
+    one per added or removed user) in total.
+
+    returns a dict with the 'teams' (usernames, same order as before, new
+    teams at the end and broken up ones empty), the indices of the teams
+    whose members 'changed', the number of 'moves' and the total 'score'
+    '''
+    engine = ScoringEngine(user_requests)
+    removed = set(removed)
+    locked = set(locked)
+    if max_moves is None:
+        max_moves = len(added) + len(removed)
+
+    missing = [x for team in teams for x in team if x not in removed and x not in engine.ids]
+    if missing:
+        raise ValueError('people on teams are missing from user_requests: %r' % missing)
+
+    members = [[engine.ids[x] for x in team if x not in removed] for team in teams]
+    original = {i: team_no for team_no, team in enumerate(members) for i in team}
+    frozen = {team_no for team_no, team in enumerate(teams) if locked.intersection(team)}
+    homeless = [engine.ids[x] for x in added if engine.ids[x] not in original]
+
+    # locked teams keep their size (even one short after a dropout), everyone
+    # else needs as many teams as they would from scratch: break up the
+    # smallest teams if there are too many, open empty ones if too few
+    unlocked = sum(len(members[team_no]) for team_no in range(len(members)) if team_no not in frozen) + len(homeless)
+    num_teams = len(frozen) + math.ceil(unlocked / TEAM_SIZE)
+    active = [team_no for team_no, team in enumerate(members) if team or team_no in frozen]
+    while len(active) > num_teams:
+        smallest = min((team_no for team_no in active if team_no not in frozen), key=lambda team_no: len(members[team_no]))
+        homeless.extend(members[smallest])
+        members[smallest] = list()
+        active.remove(smallest)
+    while len(active) < num_teams:
+        members.append(list())
+        active.append(len(members) - 1)
+    open_teams = [team_no for team_no in active if team_no not in frozen]
+
+    # the most requested/requesting people first, they have the most to lose
+    homeless.sort(key=lambda i: -(len(engine.mutual(i)) + len(engine.oneway(i))))
+    for i in homeless:
+        gains = [(engine.score_members(members[team_no] + [i]) - engine.score_members(members[team_no]), -len(members[team_no]), team_no) for team_no in open_teams if len(members[team_no]) < TEAM_SIZE]
+        if not gains:
+            raise ValueError('no room for everyone, too many people are on locked teams')
+        members[max(gains)[2]].append(i)
+
+    # short teams take whoever fits in best from a full team
+    while True:
+        sizes = [len(members[team_no]) for team_no in open_teams]
+        if max(sizes, default=0) - min(sizes, default=0) < 2:
+            break
+        short = open_teams[sizes.index(min(sizes))]
+        moves = [(engine.score_members(members[short] + [i]) - engine.score_members(members[short]) + engine.score_members([j for j in members[team_no] if j != i]) - engine.score_members(members[team_no]), team_no, i) for team_no in open_teams if len(members[team_no]) == max(sizes) for i in members[team_no]]
+        gain, team_no, i = max(moves)
+        members[team_no].remove(i)
+        members[short].append(i)
+
+    def changed(team_no: int, team: list) -> bool:
+        return team_no >= len(teams) or {engine.users[i]['username'] for i in team} != set(teams[team_no])
+
+    # local search around the teams that changed (only those, or it turns
+    # into optimizing the whole event one swap at a time)
+    engine.load(members)
+    moved = lambda i, team_no: original.get(i, team_no) != team_no
+    num_moves = sum(moved(i, engine.team_of[i]) for i in original)
+    affected = {team_no for team_no in open_teams if changed(team_no, members[team_no])}
+    while affected:
+        best = None
+        for team1_no in affected:
+            for team2_no in open_teams:
+                if team2_no == team1_no:
+                    continue
+                before = engine.scores[team1_no] + engine.scores[team2_no]
+                for i in engine.members[team1_no]:
+                    for j in engine.members[team2_no]:
+                        extra_moves = moved(i, team2_no) + moved(j, team1_no) - moved(i, team1_no) - moved(j, team2_no)
+                        if num_moves + extra_moves > max_moves:
+                            continue
+                        proposal = engine.propose(team1_no, team2_no, {i}, {j})
+                        gain = proposal[0] + proposal[1] - before
+                        if gain > 1e-9 and (best is None or gain > best[0]):
+                            best = (gain, team1_no, team2_no, i, j, extra_moves, proposal)
+        if best is None:
+            break
+
+        gain, team1_no, team2_no, i, j, extra_moves, proposal = best
+        members1 = [x for x in engine.members[team1_no] if x != i] + [j]
+        members2 = [x for x in engine.members[team2_no] if x != j] + [i]
+        engine.commit(team1_no, team2_no, members1, members2, proposal)
+        num_moves += extra_moves
+
+    return {
+        'teams': [[engine.users[i]['username'] for i in team] for team in engine.members],
+        'changed': [team_no for team_no, team in enumerate(engine.members) if changed(team_no, team)],
+        'moves': num_moves,
+        'score': sum(engine.scores)
+    }
+
+
+def _split(value) -> list:
+    # a json list, or a csv cell like "a, b; c". not on spaces, old style
+    # discord usernames (name#1234) can have them
+    if value is None:
+        return list()
+    if isinstance(value, str):
+        return [x.strip() for x in re.split(r'[,;]', value) if x.strip()]
+    return list(value)
+
+
+def _truthy(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'x')
+    return bool(value)
+
+
+def read_users(lines: typing.Iterable, format: str='jsonl') -> typing.Iterator[dict]:
+    '''
+    reads user_requests one at a time from lines (e.g. an open file) of json
+    objects or csv with a header row. every row needs a 'username' and can
+    have 'specialities' and 'team_requests' (lists, or strings separated by
+    commas or semicolons) and 'noob'. a 'noob' speciality counts as
+    noob like it does in the bot's db. anything else in a row is dropped
+    '''
+    if format not in ('jsonl', 'csv'):
+        raise ValueError('unknown input format: %r' % format)
+
+    rows = csv.DictReader(lines) if format == 'csv' else (json.loads(line) for line in lines if line.strip())
+    seen = set()
+    for line_no, row in enumerate(rows, 1):
+        username = (row.get('username') or '').strip()
+        if not username:
+            raise ValueError('row %d: no username' % line_no)
+        if username in seen:
+            raise ValueError('row %d: %r is in here twice' % (line_no, username))
+        seen.add(username)
+
+        specialities = _split(row.get('specialities'))
+        unknown = set(specialities) - set(SPECIALITIES) - {'noob'}
+        if unknown:
+            raise ValueError('row %d: unknown specialities %r (expected some of %r)' % (line_no, sorted(unknown), SPECIALITIES))
+
+        yield {
+            'username': username,
+            'specialities': [x for x in dict.fromkeys(specialities) if x != 'noob'],
+            'team_requests': _split(row.get('team_requests')),
+            'noob': _truthy(row.get('noob')) or 'noob' in specialities
+        }
 
 
 if __name__ == '__main__':
-    for team in get_optimized_teams(user_requests):
-        print('Chose team', repr_team(team))
+    parser = argparse.ArgumentParser(description='makes teams out of a registration export (jsonl or csv with username, specialities, team_requests and noob columns) and writes them as jsonl, one team per line as soon as it\'s final')
+    parser.add_argument('input', nargs='?', default='-', help='file to read, - for stdin')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='input format (default: from the file extension, jsonl for stdin)')
+    parser.add_argument('--output', '-o', default='-', help='file to write, - for stdout')
+    parser.add_argument('--team-size', type=int, default=TEAM_SIZE)
+    parser.add_argument('--specialities', help='comma separated (default: %s)' % ','.join(SPECIALITIES))
+    parser.add_argument('--seed', type=int, help='same seed and input, same teams (with --max-iterations rather than a time budget)')
+    parser.add_argument('--workers', type=int, default=1, help='processes: shards optimized side by side, or independent chains of which the best wins')
+    parser.add_argument('--time-budget', type=float, default=60, help='seconds to optimize (0 runs until it stalls, ignored with --max-iterations)')
+    parser.add_argument('--max-iterations', type=int)
+    parser.add_argument('--method', default='hillclimb', choices=['hillclimb', 'batch'])
+    parser.add_argument('--anneal', action='store_true')
+    parser.add_argument('--contract', action='store_true', help='move groups of mutual requests as units')
+    parser.add_argument('--start', default='greedy', choices=['greedy', 'random'])
+    parser.add_argument('--shard-size', type=int, default=5000, help='split bigger inputs into shards of about this many people')
+    parser.add_argument('--sample', action='store_true', help='ignore the input and use the built-in example users')
+    args = parser.parse_args()
+
+    # an iteration budget replaces the time budget, so --seed reproduces
+    if args.max_iterations:
+        args.time_budget = 0
+    if args.anneal and args.method == 'hillclimb' and not args.time_budget and not args.max_iterations:
+        parser.error('--anneal needs a --time-budget or --max-iterations to cool down over')
+
+    configure(args.team_size, _split(args.specialities) if args.specialities else None)
+    start_time = time.monotonic()
+
+    if args.sample:
+        users = user_requests
+    else:
+        input_format = args.format or ('csv' if args.input.lower().endswith('.csv') else 'jsonl')
+        with (sys.stdin if args.input == '-' else open(args.input, newline='')) as f:
+            try:
+                users = list(read_users(f, input_format))
+            except ValueError as e:
+                parser.error('%s: %s' % (args.input, e))
+    read_time = time.monotonic() - start_time
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    written = 0
+    def write_team(team: list) -> None:
+        global written
+        written += 1
+        out.write(json.dumps({'team': written, 'members': [user['username'] for user in team], 'score': score_team(team)}) + '\n')
+        out.flush()
+
+    options = {'method': args.method, 'seed': args.seed, 'time_budget': args.time_budget or None, 'max_iterations': args.max_iterations, 'anneal': args.anneal and args.method == 'hillclimb', 'contract': args.contract, 'start': args.start}
+    try:
+        if len(users) > args.shard_size:
+            result = get_optimized_teams_sharded(users, args.shard_size, workers=args.workers, on_team=write_team, **options)
+        elif args.workers > 1:
+            result = get_optimized_teams_parallel(users, chains=args.workers, workers=args.workers, **options)
+            for team in result['teams']:
+                write_team(team)
+        else:
+            for team in get_optimized_teams(users, **options):
+                write_team(team)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print('[ ] %d users in %.2fs, %d teams in %.2fs' % (len(users), read_time, written, time.monotonic() - start_time - read_time), file=sys.stderr)